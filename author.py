@@ -4,7 +4,8 @@ Review-writing module for MovieGuide
 
 import re, urllib, random
 from datetime import date
-import jsonapi, wikidata, wikipedia
+from multiprocessing.pool import ThreadPool
+import common, imdblocal, jsonapi, wikidata, wikidata_dump, wikipedia, cache
 
 def grouped_num(num, char=',', size=3):
     """Impose digit grouping on integer num"""
@@ -39,9 +40,12 @@ def strip_qv(data):
     return QV_RE.sub(_replacement, data)
 
 def imdb_url(movie):
-    """Build a URL to the IMDb page of a movie object."""
+    """Build a URL to the IMDb page of a movie object, or to a search for
+    its title if it has no IMDb ID."""
+    if movie.get('imdbid'):
+        return 'http://www.imdb.com/title/%s/' % (movie['imdbid'],)
     return 'http://www.imdb.com/Title?%s' % \
-        (urllib.quote_plus(movie['title'].encode('iso-8859-1')),)
+        (urllib.quote_plus(movie['title'].encode('utf-8')),)
 
 # Transformations to apply to certificate strings
 def certificate_usa(text):
@@ -264,7 +268,8 @@ def write_freebase_awards(fbdata):
         if awardname in CANONICAL_AWARD:
             awardname = CANONICAL_AWARD[awardname]
         if awardname in MAJOR_AWARDS:
-            awardname = '%s %s' % (award['year'], awardname)
+            if award['year']:
+                awardname = '%s %s' % (award['year'], awardname)
             if awardname not in awards:
                 awards[awardname] = {}
             awards[awardname][awardcat] = awardval
@@ -329,13 +334,57 @@ REVIEW_SECTIONS = ('vitals+rating', 'plot|summary|invented_plot',
 CROSSREF_URLS = ('IMDb', 'Wikipedia', 'Rotten Tomatoes', 'Metacritic',
                  'Netflix', 'Wikidata', 'Freebase')
 
+# Maximum number of IMDb search results to keep in the cache
+IMDB_CACHE_ENTRIES = 20000
+# Maximum number of Wikidata entities and query results in the cache
+WIKIDATA_CACHE_ENTRIES = 20000
+# Maximum size (compressed) of parsed Wikipedia articles in the cache
+WIKIPEDIA_CACHE_BYTES = 16*1024*1024
+
 class Author(object):
     """Class for holding state variables relating to writing reviews."""
 
-    def __init__(self, imdburl='http://localhost:8051/imdb', freebasekey=None):
-        self.imdb = jsonapi.IMDbAPI(imdburl)
-        self.wikidata = wikidata.WikidataQuery()
-        self.wikipedia = wikipedia.Wikipedia()
+    def __init__(self, imdburl='http://localhost:8051/imdb', freebasekey=None,
+                 cachefile=None, wikipedia_streaming=False,
+                 wikidata_index=None, imdb_index=None, workers=1):
+        imdbcache, wdcache, wpcache = (None, None, None)
+        if cachefile:
+            imdbcache = cache.Cache(cachefile, 'imdb_search',
+                                    max_entries=IMDB_CACHE_ENTRIES)
+            wdcache = cache.Cache(cachefile, 'wikidata',
+                                  max_entries=WIKIDATA_CACHE_ENTRIES)
+            wpcache = cache.Cache(cachefile, 'wikipedia',
+                                  max_bytes=WIKIPEDIA_CACHE_BYTES,
+                                  compress=True)
+        if imdb_index:
+            self.imdb = imdblocal.IMDbLocal(imdb_index)
+        else:
+            self.imdb = jsonapi.IMDbAPI(imdburl, cache=imdbcache)
+        wdindex = wikidata_dump.WikidataIndex(wikidata_index) \
+            if wikidata_index else None
+        self.wikidata = wikidata.WikidataQuery(cache=wdcache, index=wdindex)
+        self.wikipedia = wikipedia.Wikipedia(cache=wpcache,
+                                             streaming=wikipedia_streaming)
+        # Reviews started by process_item_async wait on lookups, so they
+        # run on a pool of their own rather than the shared lookup pool
+        self.pool = ThreadPool(workers)
+
+    def prefetch(self, items):
+        """Warm the caches for a batch of items (title, year) which are about
+        to be looked up, using bulk requests to IMDb and Wikidata. Does
+        nothing without a cache."""
+        if not self.wikidata.cache:
+            return
+        imdbids = [movie['imdbid'] for movie in self.imdb.search_many(items)
+                   if not isinstance(movie, jsonapi.IMDbError) and
+                   'imdbid' in movie]
+        if imdbids:
+            self.wikidata.by_imdbids(imdbids)
+
+    def process_item_async(self, title, year):
+        """Start writing a review on the review pool, returning an
+        AsyncResult for the result of process_item."""
+        return self.pool.apply_async(self.process_item, (title, year))
 
     def process_item(self, title, year):
         """Look up an item by title and year and write a review."""
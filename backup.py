@@ -1,32 +1,106 @@
 #!/usr/bin/env python
 
-"""Back up the database (using HTTP POST)."""
+"""Back up the database (using HTTP POST).
+
+Backups are gzipped SQL, named TIMESTAMP-TYPE-SHA1SUM.gz, where TYPE is
+F for a full dump, C for statements from the changelog (see
+schema_upgrade.changelog_triggers), or I for a diff between dumps (made
+by older versions).
+"""
 
-from subprocess import Popen, PIPE
-from cStringIO import StringIO
 from gzip import GzipFile
-import re, os, shutil, difflib, time, urllib2, urlparse, hashlib
+import re, os, time, urlparse, hashlib, struct, sqlite3, tempfile, zlib
+from multiprocessing.pool import ThreadPool
+
+import httpclient
+
+# Size of chunks of compressed data sent or received in a backup.
+CHUNK_SIZE = 64*1024
+
+# Timeouts for connecting to the backup server and reading from it, in
+# seconds.
+TIMEOUT = (30, 2*60)
+
+# Number of backup files to download at once.
+FETCH_WORKERS = 4
+
+# Number of pages to copy per step of a snapshot, and the pause between
+# steps (letting the bot write to the database). After SNAPSHOT_RETRIES
+# restarts, the snapshot is finished in one step.
+SNAPSHOT_PAGES = 64
+SNAPSHOT_SLEEP = 0.01
+SNAPSHOT_RETRIES = 5
+
+def snapshot(database_file, snapshot_file, pages=SNAPSHOT_PAGES):
+    """Make a consistent copy of an sqlite3 database that is in use, a few
+    pages at a time, like the sqlite3 online backup API (which Python 2's
+    sqlite3 module does not expose). Each step holds a shared lock only
+    while it copies its pages; if the database is modified between steps,
+    the copy starts over (a few times, before copying in one step)."""
+    dbh = sqlite3.connect(database_file, isolation_level=None)
+    assert dbh.execute("PRAGMA journal_mode").fetchone()[0] != 'wal'
+    infh = open(database_file, 'rb')
+    outfh = open(snapshot_file, 'wb')
+    try:
+        page, counter, restarts = 0, None, -1
+        while True:
+            dbh.execute("BEGIN")
+            try:
+                # Take a shared lock, so no one can write the file
+                dbh.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+                infh.seek(0)
+                header = infh.read(100)
+                page_size = struct.unpack('>H', header[16:18])[0]
+                page_size = 65536 if page_size == 1 else page_size
+                if header[24:28] != counter:
+                    # File change counter: modified since the last step
+                    page, counter = 0, header[24:28]
+                    outfh.seek(0)
+                    outfh.truncate()
+                    restarts += 1
+                total = os.fstat(infh.fileno()).st_size // page_size
+                end = min(page + pages, total) \
+                    if restarts < SNAPSHOT_RETRIES else total
+                infh.seek(page * page_size)
+                outfh.write(infh.read((end - page) * page_size))
+                page = end
+            finally:
+                dbh.execute("COMMIT")
+            if page >= total:
+                break
+            time.sleep(SNAPSHOT_SLEEP)
+    finally:
+        outfh.close()
+        infh.close()
+        dbh.close()
 
 def dump(filename):
-    """Dump an sqlite3 database."""
-    obj = Popen(['sqlite3', filename, '.dump'], stdout=PIPE)
-    for i in obj.stdout:
-        yield i.strip()
-    obj.wait()
-    assert obj.returncode == 0
-
-def gzip(data):
-    """Compress a string with gzip."""
-    hasher = hashlib.sha1()
-    compressed_data = StringIO()
-    gzfh = GzipFile(mode='w', fileobj=compressed_data)
+    """Dump an sqlite3 database, one (UTF-8) statement at a time."""
+    dbh = sqlite3.connect(filename)
+    try:
+        for i in dbh.iterdump():
+            yield i.strip().encode('utf-8')
+    finally:
+        dbh.close()
+
+def gzip(data, hasher, chunk_size=CHUNK_SIZE):
+    """Compress lines with gzip, generating chunks of compressed data of
+    about chunk_size bytes. The uncompressed data is added to hasher."""
+    compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    buf = []
+    size = 0
     for i in data:
-        gzfh.write(i + '\n')
         hasher.update(i + '\n')
-    gzfh.close()
-    buf = compressed_data.getvalue()
-    compressed_data.close()
-    return hasher.hexdigest(), buf
+        chunk = compressor.compress(i + '\n')
+        if chunk:
+            buf.append(chunk)
+            size += len(chunk)
+            if size >= chunk_size:
+                yield ''.join(buf)
+                buf = []
+                size = 0
+    buf.append(compressor.flush())
+    yield ''.join(buf)
 
 def gunzip_file(pathname, checksum=None):
     """Decompress a file with gzip."""
@@ -37,83 +111,172 @@ def gunzip_file(pathname, checksum=None):
         assert hashlib.sha1(data).hexdigest() == checksum
     return data
 
-def http_request(method, url, data, auth=(),
-                 mimetype='application/octet-stream'):
-    """Implementation of HTTP/WebDAV methods, including PUT and PROPFIND."""
-    class MyRequest(urllib2.Request):
-        """Request object for arbitrary HTTP/WebDAV methods. (PUT,
-        PROPFIND, etc.)"""
-        def get_method(self):
-            return method
-
-    password_mgr = urllib2.HTTPPasswordMgrWithDefaultRealm()
-    if auth:
-        password_mgr.add_password(None, url, auth[0], auth[1])
-    opener = urllib2.build_opener(urllib2.HTTPBasicAuthHandler(password_mgr),
-                                  urllib2.HTTPHandler)
+def http_put_stream(url, chunks, auth=(),
+                    mimetype='application/octet-stream'):
+    """Send a PUT request whose body is generated in chunks, using chunked
+    transfer encoding. Returns the number of bytes sent."""
+    sizes = []
+    def _count(chunks):
+        """Count the bytes in the chunks as they are sent."""
+        for chunk in chunks:
+            sizes.append(len(chunk))
+            yield chunk
+    response = httpclient.request('PUT', url, _count(chunks),
+                                  {'Content-Type': mimetype}, auth,
+                                  timeout=TIMEOUT, compress=False)
+    response.read()
+    assert response.status >= 200 and response.status < 300
+    return sum(sizes)
+
+def http_open(method, url, data, auth=(),
+              mimetype='application/octet-stream', headers=None):
+    """Implementation of HTTP/WebDAV methods, including PUT, PROPFIND and
+    MOVE. Returns the response as a file-like object."""
+    headers = dict(headers or {})
     if method in ('PUT', 'POST'):
         assert data is not None
-        request = MyRequest(url, data, headers={'Content-Type': mimetype})
+        headers['Content-Type'] = mimetype
     else:                       # A GET or PROPFIND request or something
         assert data is None
-        request = MyRequest(url)
-    obj = opener.open(request, timeout=2*60)
+    obj = httpclient.request(method, url, data, headers, auth,
+                             timeout=TIMEOUT)
     code = obj.getcode()
     if method == 'GET':
         assert code == 200
     else:
         assert code >= 200 and code < 300
-    return obj.read()
+    return obj
 
-def run_backup(database_file, remote, auth=(), full_backup=False, min_size=0):
-    """Back up the database."""
+def http_request(method, url, data, auth=(),
+                 mimetype='application/octet-stream', headers=None):
+    """Make an HTTP/WebDAV request with http_open and return the response
+    body."""
+    obj = http_open(method, url, data, auth, mimetype, headers)
+    data = obj.read()
+    obj.close()
+    return data
 
-    # Filenames
-    incr_file = database_file + '.incr'
+def changelog(database_file, after_seq):
+    """Return the number of changes logged after a sequence number, the
+    latest sequence number, and an iterator over the logged statements.
+    The statements are copied to a temporary file first, so the database
+    is not kept locked while they are sent."""
+    dbh = sqlite3.connect(database_file)
+    try:
+        count, last_seq = dbh.execute("SELECT COUNT(*), MAX(seq) " +
+                                      "FROM changelog WHERE seq>?",
+                                      [after_seq]).fetchone()
+        spool = tempfile.TemporaryFile()
+        for row in dbh.execute("SELECT statement FROM changelog " +
+                               "WHERE seq>? AND seq<=? ORDER BY seq",
+                               [after_seq, last_seq]):
+            spool.write(row[0].encode('utf-8') + ';\n')
+    finally:
+        dbh.close()
+    def _statements():
+        """Read the statements back from the temporary file."""
+        try:
+            spool.seek(0)
+            # A statement may span lines, but gzip adds the newlines back
+            for line in spool:
+                yield line[:-1]
+        finally:
+            spool.close()
+    return count, last_seq or after_seq, _statements()
+
+def prune_changelog(database_file, seq):
+    """Delete changes which have been backed up from the changelog."""
+    dbh = sqlite3.connect(database_file)
+    dbh.execute("DELETE FROM changelog WHERE seq<=?", [seq])
+    dbh.commit()
+    dbh.close()
+
+def discard_changelog(database_file):
+    """Empty the changelog when no backups are made, and forget the last
+    backup, so that the next backup (if backups are enabled again) is a
+    full backup."""
+    seq_file = database_file + '.backup-seq'
+    if os.path.exists(seq_file):
+        os.remove(seq_file)
+    dbh = sqlite3.connect(database_file)
+    dbh.execute("DELETE FROM changelog")
+    dbh.commit()
+    dbh.close()
+
+def timestamp():
+    """Return the current time, as used in backup filenames."""
+    return time.strftime("%Y%m%dT%H%M%SZ", time.gmtime())
+
+def upload_backup(remote, now, typecode, data, auth=()):
+    """Compress and send lines of a backup as they are generated, returning
+    its filename and compressed size."""
+    # Generate a temporary filename: the checksum isn't known until the
+    # whole backup has been sent.
+    if remote[-1] != '/':
+        remote += '/'  # Always treat the URL as being to a directory
+    tempname = urlparse.urljoin(remote, ".%s-%s.gz.part" % (now, typecode))
+    hasher = hashlib.sha1()
+    size = http_put_stream(tempname, gzip(data, hasher), auth)
 
-    # Load new data
-    data = tuple(dump(database_file))
+    # Move it to its permanent filename
+    filename = "%s-%s-%s.gz" % (now, typecode, hasher.hexdigest())
+    http_request('MOVE', tempname, None, auth,
+                 headers={'Destination': urlparse.urljoin(remote, filename),
+                          'Overwrite': 'F'})
+    return filename, size
 
-    if not full_backup and os.path.exists(incr_file):
-        # Load old data and perform incremental backup
-        print "Performing incremental database backup:"
-        old_data = dump(incr_file)
-        data = tuple(difflib.unified_diff(tuple(old_data), tuple(data),
-                                          lineterm=''))
-    else:
-        print "Performing full database backup:"
-        full_backup = True
+def run_backup(database_file, remote, auth=(), full_backup=False, min_size=0):
+    """Back up the database. A full backup is a dump of a snapshot of the
+    database; an incremental backup contains the statements logged in the
+    changelog since the last backup."""
 
-    if not data:
-        print "  No changes."
-        return True
+    # Filenames: the sequence number of the last change backed up, and a
+    # temporary snapshot for full backups.
+    seq_file = database_file + '.backup-seq'
+    snapshot_file = database_file + '.snapshot'
 
-    if min_size and len(data) < min_size: # Measured in lines, not bytes
-        print "  Not enough changes. (%d < %d lines)" % (len(data), min_size)
-        return False
+    if not full_backup and os.path.exists(seq_file):
+        # Send the changes logged since the last backup
+        print "Performing incremental database backup:"
+        with open(seq_file) as seqfh:
+            acked_seq = int(seqfh.read())
+        count, last_seq, data = changelog(database_file, acked_seq)
 
-    # Encode message
-    checksum, message = gzip(data)
+        if not count:
+            print "  No changes."
+            return True
 
-    # Generate output filename
-    now = time.strftime("%Y%m%dT%H%M%SZ", time.gmtime())
-    typecode = 'F' if full_backup else 'I'
-    filename = "%s-%s-%s.gz" % (now, typecode, checksum)
-    if remote[-1] != '/':
-        remote += '/'  # Always treat the URL as being to a directory
-    filename = urlparse.urljoin(remote, filename)
-    #print filename
-
-    # Send message
-    if True:
-        print "  Sending %d bytes..." % len(message)
-        http_request('PUT', filename, message, auth)
-        print "  Backup complete."
+        if min_size and count < min_size: # Measured in statements
+            print "  Not enough changes. (%d < %d lines)" % (count, min_size)
+            return False
     else:
-        print message.as_string()
-
-    # Save new incremental file
-    shutil.copy(database_file, incr_file)
+        # Take a consistent snapshot of the database, then dump it (The
+        # snapshot's changelog is pending changes which it includes.)
+        print "Performing full database backup:"
+        full_backup = True
+        snapshot(database_file, snapshot_file)
+        dbh = sqlite3.connect(snapshot_file)
+        last_seq = dbh.execute("SELECT MAX(seq) FROM changelog") \
+                      .fetchone()[0] or 0
+        dbh.close()
+        data = (i for i in dump(snapshot_file)
+                if not i.startswith('INSERT INTO "changelog"'))
+
+    # Send it
+    typecode = 'F' if full_backup else 'C'
+    print "  Sending..."
+    try:
+        filename, size = upload_backup(remote, timestamp(), typecode, data,
+                                       auth)
+    finally:
+        if full_backup:
+            os.remove(snapshot_file)
+    print "  Backup complete. (%d bytes)" % (size,)
+
+    # Remember (and forget) the changes that have been backed up
+    with open(seq_file, 'w') as seqfh:
+        seqfh.write('%d\n' % (last_seq,))
+    prune_changelog(database_file, last_seq)
     return True
 
 FILENAME_RE = re.compile(r'^([0-9TZ]+)-([A-Z])-([0-9a-f]+)\.gz$', flags=re.I)
@@ -125,77 +288,124 @@ def parse_filename(filename):
     return match.group(1).upper(), match.group(2).upper(), \
         match.group(3).lower()
 
-def parse_propfind(xml):
-    """Parse the XML result of a PROPFIND request."""
-    def _text(node):
-        """Return concatenation of child nodes (textNodes assumed)."""
-        return ''.join(item.data for item in node.childNodes)
-
-    from xml.dom.minidom import parseString
-    propfind = parseString(xml)
+def parse_propfind(xmlfh):
+    """Parse the XML result of a PROPFIND request incrementally from a
+    file-like object."""
+    from xml.etree.cElementTree import iterparse
 
-    for item in propfind.documentElement.getElementsByTagName('d:response'):
-        path = _text(item.getElementsByTagName('d:href')[0])
-        size = int(_text(item.getElementsByTagName('d:getcontentlength')[0]))
-        if path[-1] == '/' or item.getElementsByTagName('d:collection'):
+    for event, item in iterparse(xmlfh):
+        if item.tag != '{DAV:}response':
+            continue
+        path = item.findtext('{DAV:}href')
+        size = int(item.findtext('.//{DAV:}getcontentlength') or -1)
+        if path[-1] == '/' or item.find('.//{DAV:}collection') is not None:
             size = -1
+        item.clear()
 
         # Determine local filename and remote URL
         filename = path.rstrip('/').split('/')[-1]
         yield(filename, path, size)
 
-def fetch_backup(localdir, remote, auth=(), keep_only=None):
+def download_file(fileurl, filepath, size, checksum, auth=()):
+    """Download a backup file, or the rest of a partly downloaded file,
+    verifying the checksum of its decompressed contents as it is
+    written."""
+    hasher = hashlib.sha1()
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    headers = {}
+
+    # Resume a partial download
+    offset = os.path.getsize(filepath) if os.path.exists(filepath) else 0
+    if offset > size:
+        offset = 0
+    if offset:
+        headers['Range'] = 'bytes=%d-' % (offset,)
+    response = httpclient.request('GET', fileurl, headers=headers, auth=auth,
+                                  timeout=TIMEOUT, compress=False)
+    if response.status == 200:
+        offset = 0              # Server sent the whole file
+    else:
+        assert offset and response.status == 206
+    try:
+        if offset:
+            with open(filepath, 'rb') as infh:
+                for chunk in iter(lambda: infh.read(CHUNK_SIZE), ''):
+                    hasher.update(decompressor.decompress(chunk))
+
+        with open(filepath, 'ab' if offset else 'wb') as outfh:
+            for chunk in iter(lambda: response.read(CHUNK_SIZE), ''):
+                outfh.write(chunk)
+                hasher.update(decompressor.decompress(chunk))
+        hasher.update(decompressor.flush())
+    except zlib.error:
+        os.remove(filepath)     # Corrupt: don't resume it next time
+        raise
+    assert os.path.getsize(filepath) == size
+    if hasher.hexdigest() != checksum:
+        os.remove(filepath)     # Corrupt: don't resume it next time
+    assert hasher.hexdigest() == checksum
+    return offset
+
+def fetch_backup(localdir, remote, auth=(), keep_only=None,
+                 workers=FETCH_WORKERS):
     """Download updates to a backup directory from a WebDAV server."""
     if remote[-1] != '/':
         remote += '/'  # Always treat the URL as being to a directory
 
     # Do PROPFIND on the remote directory and parse the XML
-    filenames = list(parse_propfind(http_request('PROPFIND', remote,
-                                                 None, auth)))
-
-    # Enumerate the items in the directory and download missing items
-    fullbackups = []
-    for filename, path, size in filenames:
+    response = http_open('PROPFIND', remote, None, auth)
+    filenames = []
+    for filename, path, size in parse_propfind(response):
         if size < 0:
             # Skip subdirectories (collections)
             print "%s seems to be a collection, skipping" % path
             continue
-
-        # Determine local filename and remote URL
-        filepath = os.path.join(localdir, filename)
-        fileurl = urlparse.urljoin(remote, path)
-        #filenames.append(fileurl)
         fndata = parse_filename(filename)
-        print filename
-
-        # Track full backups for use in expiration
-        assert fndata[1] in 'FI'
-        if fndata[1] == 'F' and keep_only:
-            fullbackups.append(filename)
-        # Check if the file is already downloaded
-        if os.path.exists(filepath):
-            if os.path.getsize(filepath) == size:
-                print "  (Hit)"
-                continue
-            print "  (Invalid)"
-
-        # FIXME: Check if file is expired, don't download
+        if not fndata:
+            # Skip unfinished uploads, etc.
+            print "%s has invalid filename, skipping" % filename
+            continue
+        assert fndata[1] in 'FIC'
+        filenames.append((filename, path, size, fndata))
+    response.close()
+
+    # Backups older than the most recent keep_only full backups expire
+    threshold = None
+    fullbackups = sorted(filename for filename, path, size, fndata
+                         in filenames if fndata[1] == 'F')
+    if keep_only and len(fullbackups) > keep_only:
+        threshold = fullbackups[-keep_only]
 
-        print "  (Downloading...)"
-        outfh = open(filepath, 'wb')
-        outfh.write(http_request('GET', fileurl, None, auth))
-        outfh.close()
-        assert os.path.getsize(filepath) == size
-        # Verify checksum (fndata[2] = checksum)
-        gunzip_file(filepath, fndata[2])
-        print "  (OK)"
+    # Enumerate the items in the directory and find missing items
+    downloads = []
+    for filename, path, size, fndata in filenames:
+        if threshold and filename < threshold:
+            continue
+        filepath = os.path.join(localdir, filename)
+        if os.path.exists(filepath) and os.path.getsize(filepath) == size:
+            print "%s (Hit)" % filename
+            continue
+        downloads.append((filename, urlparse.urljoin(remote, path),
+                          filepath, size, fndata[2]))
+
+    # Download them (fndata[2] = checksum)
+    def _download(item):
+        """Download a file, returning a message about it."""
+        filename, fileurl, filepath, size, checksum = item
+        offset = download_file(fileurl, filepath, size, checksum, auth)
+        return "%s (%s OK)" % (filename, "Resumed at %d," % (offset,)
+                               if offset else "Downloaded,")
+    pool = ThreadPool(workers)
+    try:
+        for message in pool.imap_unordered(_download, downloads):
+            print message
+    finally:
+        pool.close()
 
     # Delete expired files
-    if keep_only and len(fullbackups) > keep_only:
-        fullbackups.sort()
-        threshold = fullbackups[-keep_only]
-        for filename, path, size in filenames:
-            if size < 0 or filename >= threshold:
+    if threshold:
+        for filename, path, size, fndata in filenames:
+            if filename >= threshold:
                 continue
             # Determine local filename and remote URL
             filepath = os.path.join(localdir, filename)
@@ -206,13 +416,19 @@ def fetch_backup(localdir, remote, auth=(), keep_only=None):
             if os.path.exists(filepath):
                 os.remove(filepath)
 
-def restore_backup(localdir, outname):
-    """Restore a database backup from a local backup directory."""
-
-    # Enumerate data files and find most recent set of full +
-    # incremental backups
+def backup_chain(localdir, until=None):
+    """Find the most recent full backup in a local backup directory (made
+    no later than until, if given) and the incremental backups following
+    it, returning a list of (filename, pathname, fndata)."""
+    def _order(filename):
+        """Sort by time, with a full backup made by compact_backup after
+        the incremental backup it was named for."""
+        fndata = parse_filename(filename)
+        if not fndata:
+            return (filename, False, filename)
+        return (fndata[0], fndata[1] == 'F', filename)
     files = []
-    for filename in sorted(os.listdir(localdir)):
+    for filename in sorted(os.listdir(localdir), key=_order):
         pathname = os.path.join(localdir, filename)
         if os.path.isdir(pathname):
             print "%s is a directory: skipping." % filename
@@ -222,35 +438,164 @@ def restore_backup(localdir, outname):
             print "%s has invalid filename: skipping." % filename
             continue
         datatype = fndata[1]
+        if until and fndata[0] > until:
+            break
 
         if datatype == 'F':
             # A newer full backup; clear the list of files
             files = []
-        if datatype in 'FI':
+        if datatype not in 'FIC':
+            print "%s has invalid datatype '%s'" % (filename, datatype)
+        elif files or datatype == 'F':
             files.append((filename, pathname, fndata))
+    return files
+
+HUNK_RE = re.compile(r'^@@ -(\d+)(?:,(\d+))? \+\d+(?:,\d+)? @@')
+def patch_lines(lines, diff):
+    """Apply a unified diff, as made by difflib.unified_diff, to a list of
+    lines. Returns the patched list."""
+    result = []
+    pos = 0
+    in_hunk = False
+    for line in diff:
+        match = HUNK_RE.match(line)
+        if match:
+            # Copy the unchanged lines up to the hunk
+            start = int(match.group(1))
+            if match.group(2) != '0':
+                start -= 1
+            assert start >= pos
+            result.extend(lines[pos:start])
+            pos = start
+            in_hunk = True
+        elif not in_hunk:
+            continue            # File headers
+        elif line[:1] == ' ':
+            assert lines[pos] == line[1:]
+            result.append(lines[pos])
+            pos += 1
+        elif line[:1] == '-':
+            assert lines[pos] == line[1:]
+            pos += 1
+        elif line[:1] == '+':
+            result.append(line[1:])
         else:
-            print "%s has invalid datatype '%s'" % (filename, datatype)
-
-    # Process the selected batch of files
-    for i, (filename, pathname, fndata) in enumerate(files):
+            raise ValueError('Invalid line in diff: %r' % (line,))
+    result.extend(lines[pos:])
+    return result
+
+def chain_lines(files):
+    """Apply a chain of backup files (from backup_chain) in-process,
+    returning the lines of SQL which restore the database."""
+    lines = []
+    for filename, pathname, fndata in files:
         print filename
-
-        # Decompress the backup file
-        data = gunzip_file(pathname, fndata[2]) # fndata[2] = checksum
-
-        # The first file should always be the full backup
-        if i == 0:
-            outfh = open(outname, 'w')
-            outfh.write(data)
-            outfh.close()
+        # Decompress the backup file (fndata[2] = checksum)
+        data = gunzip_file(pathname, fndata[2]).split('\n')
+        if data[-1] == '':
+            data.pop()
+
+        if fndata[1] == 'I':
+            # Older incremental backups are diffs between dumps
+            lines = patch_lines(lines, data)
         else:
-            obj = Popen(['patch', outname], stdin=PIPE)
-            obj.stdin.write(data)
-            obj.stdin.close()
-            obj.wait()
-            assert obj.returncode == 0
+            # Full dump, or changelog statements to run after it
+            lines.extend(data)
+    return lines
+
+# Statements in dumps which control transactions, which restore_backup
+# manages itself.
+TRANSACTION_STATEMENTS = ('BEGIN TRANSACTION;', 'COMMIT;',
+                          'PRAGMA foreign_keys=OFF;')
+
+def split_statements(lines):
+    """Join lines of SQL into complete statements."""
+    buf = []
+    for line in lines:
+        buf.append(line)
+        statement = '\n'.join(buf)
+        if sqlite3.complete_statement(statement):
+            yield statement
+            buf = []
+    assert not '\n'.join(buf).strip()
+
+def load_database(outname, lines):
+    """Load lines of SQL into a new database file in a single
+    transaction."""
+    assert not os.path.exists(outname)
+    dbh = sqlite3.connect(outname, isolation_level=None)
+    try:
+        # It's a new file: if anything goes wrong, it is thrown away
+        dbh.execute("PRAGMA journal_mode=OFF")
+        dbh.execute("PRAGMA synchronous=OFF")
+        dbh.execute("BEGIN")
+        for statement in split_statements(lines):
+            if statement not in TRANSACTION_STATEMENTS:
+                dbh.execute(statement.decode('utf-8'))
+        # Changes replayed from the changelog were logged again; they are
+        # all in the backup already.
+        if dbh.execute("SELECT 1 FROM sqlite_master WHERE type='table' " +
+                       "AND name='changelog'").fetchone():
+            dbh.execute("DELETE FROM changelog")
+        dbh.execute("COMMIT")
+        dbh.close()
+    except:
+        dbh.close()
+        os.remove(outname)
+        raise
+
+def restore_backup(localdir, outname, until=None, sql=False):
+    """Restore a database backup from a local backup directory to a new
+    database file (or a file of SQL), as of the time until if given."""
+    files = backup_chain(localdir, until)
+    assert files, "No full backup found"
+    lines = chain_lines(files)
+    if sql:
+        with open(outname, 'w') as outfh:
+            for line in lines:
+                outfh.write(line + '\n')
+    else:
+        load_database(outname, lines)
     print "Done"
 
+def compact_backup(localdir, remote=None, auth=(), until=None):
+    """Fold the most recent full backup and its incremental backups into
+    a new full backup, named for the time of the last of them, in the local
+    directory and (if remote is given) on the server."""
+    files = backup_chain(localdir, until)
+    if len(files) < 2:
+        print "Nothing to compact."
+        return None
+    now = files[-1][2][0]
+    tempdb = os.path.join(localdir, '.%s-F.db' % (now,))
+    tempname = os.path.join(localdir, '.%s-F.gz.part' % (now,))
+    if os.path.exists(tempdb):
+        os.remove(tempdb)
+    try:
+        load_database(tempdb, chain_lines(files))
+
+        # Write the new full backup locally
+        print "Writing full backup..."
+        hasher = hashlib.sha1()
+        with open(tempname, 'wb') as outfh:
+            for chunk in gzip(dump(tempdb), hasher):
+                outfh.write(chunk)
+        filename = "%s-F-%s.gz" % (now, hasher.hexdigest())
+        os.rename(tempname, os.path.join(localdir, filename))
+        print filename
+
+        # And upload it
+        if remote:
+            print "Sending..."
+            filename, size = upload_backup(remote, now, 'F', dump(tempdb),
+                                           auth)
+            print "  Backup complete. (%d bytes)" % (size,)
+    finally:
+        os.remove(tempdb)
+        if os.path.exists(tempname):
+            os.remove(tempname)
+    return filename
+
 def _main(argv):
     """Main entry point for command-line usage"""
     def _parse_userandpass(data):
@@ -258,6 +603,11 @@ def _main(argv):
         authdata = tuple(data.split(':', 1))
         assert len(authdata) == 2
         return authdata
+    def _parse_timestamp(data):
+        """Check a TIMESTAMP argument is in the format of backup
+        filenames."""
+        time.strptime(data.upper(), "%Y%m%dT%H%M%SZ")
+        return data.upper()
     parser = ArgumentParser()
     parser.add_argument('--remote', metavar='URL', type=str,
                         default='http://www.myserver.example/dav/backup',
@@ -277,17 +627,40 @@ def _main(argv):
                                   help='Fetch data from the remote backup')
     fetch.add_argument('--keep-only', metavar='NUMBER', type=int, default=None,
                        help='Number of full backups to keep')
+    fetch.add_argument('--workers', metavar='NUMBER', type=int,
+                       default=FETCH_WORKERS,
+                       help='Number of files to download at once')
     fetch.add_argument('localdir', metavar='DIRECTORY',
                        help='Location of local backup')
     restore = subparsers.add_parser('restore',
-                                    help='Restore from backup to STDOUT')
+                                    help='Restore from backup to a new '
+                                    'database file')
+    restore.add_argument('--until', metavar='TIMESTAMP',
+                         type=_parse_timestamp, default=None,
+                         help='Restore the state as of TIMESTAMP '
+                         '(YYYYMMDDTHHMMSSZ)')
+    restore.add_argument('--sql', action='store_true', default=False,
+                         help='Write SQL statements instead of a database')
     restore.add_argument('localdir', metavar='DIRECTORY',
                          help='Location of local backup')
     restore.add_argument('outfile', metavar='FILE',
                          help='Location of output file')
+    compact = subparsers.add_parser('compact',
+                                    help='Fold incremental backups into a '
+                                    'new full backup')
+    compact.add_argument('--until', metavar='TIMESTAMP',
+                         type=_parse_timestamp, default=None,
+                         help='Compact the backups made up to TIMESTAMP '
+                         '(YYYYMMDDTHHMMSSZ)')
+    compact.add_argument('--upload', action='store_true', default=False,
+                         help='Send the new full backup to the remote '
+                         'directory')
+    compact.add_argument('localdir', metavar='DIRECTORY',
+                         help='Location of local backup')
     backup.set_defaults(mode='backup')
     fetch.set_defaults(mode='fetch')
     restore.set_defaults(mode='restore')
+    compact.set_defaults(mode='compact')
 
     args = parser.parse_args(argv)
     if args.mode == 'backup':
@@ -295,9 +668,14 @@ def _main(argv):
     elif args.mode == 'fetch':
         assert args.keep_only is None or args.keep_only > 0
         fetch_backup(args.localdir, args.remote,
-                     args.auth, keep_only=args.keep_only)
+                     args.auth, keep_only=args.keep_only,
+                     workers=args.workers)
     elif args.mode == 'restore':
-        restore_backup(args.localdir, args.outfile)
+        restore_backup(args.localdir, args.outfile, until=args.until,
+                       sql=args.sql)
+    elif args.mode == 'compact':
+        compact_backup(args.localdir, args.remote if args.upload else None,
+                       args.auth, until=args.until)
     else:
         raise NotImplementedError('Unknown mode: %s' % args.mode)
 
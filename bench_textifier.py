@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+"""
+Benchmark wikipedia.WikipediaTextifier against the original implementation,
+on article HTML saved from Wikipedia. Use --fetch to save the articles the
+way the bot loads them (action=parse), then benchmark the saved files.
+
+Usage: bench_textifier.py --fetch DIRECTORY TITLE...
+       bench_textifier.py [--repeat N] PAGE.html...
+"""
+
+from HTMLParser import HTMLParser
+import codecs
+import os
+import sys
+import time
+
+import httpclient
+import wikipedia
+
+SKIPTAGS = ('table', 'sup')
+NESTTAGS = ('div', 'span', 'a')
+HEADTAGS = tuple('h'+str(i) for i in range(6))
+
+class ReferenceTextifier(HTMLParser):
+    """The original WikipediaTextifier, for comparison."""
+    def __init__(self):
+        HTMLParser.__init__(self)
+        self.buffer = ''
+        self.skip = 0
+        self.skipsect = 0
+        self.inheading = 0
+        self.headingbuf = ""
+        self.links = []
+
+    def _append(self, data):
+        if not self.skip and not self.skipsect:
+            self.buffer += data
+
+    def handle_starttag(self, tag, attrs):
+        tag = tag.lower()
+        adict = dict(attrs)
+        if tag == 'a' and 'external' in adict.get('class', '') and \
+                'href' in adict:
+            self.links.append(adict['href'])
+        if (self.skip and tag in NESTTAGS) or tag in SKIPTAGS:
+            self.skip += 1
+        elif tag in NESTTAGS:
+            aclass = adict.get('class', '')
+            astyle = adict.get('style', '')
+            if 'thumbcaption' in aclass or 'quotebox' in aclass or \
+                    'autonumber' in aclass or 'hatnote' in aclass or \
+                    'display:none' in astyle or 'display: none' in astyle:
+                self.skip += 1
+        elif tag in ('p', 'br'):
+            self._append("\n")
+        elif tag in HEADTAGS:
+            level = int(tag[1])
+            if level <= self.skipsect:
+                self.skipsect = 0
+            self.inheading = level
+            self.headingbuf = ""
+
+    def handle_endtag(self, tag):
+        tag = tag.lower()
+        if (self.skip and tag in NESTTAGS) or tag in SKIPTAGS:
+            self.skip -= 1
+        elif tag in HEADTAGS:
+            if self.inheading:
+                self.headingbuf = self.headingbuf.replace('[edit]', '').strip()
+                if self.headingbuf.lower() in wikipedia.SKIPSECTS:
+                    self.skipsect = self.inheading
+                self._append("\n\n%s %s\n\n" % ("#"*self.inheading,
+                                                self.headingbuf))
+                self.inheading = 0
+
+    def handle_data(self, data):
+        data = wikipedia.SPACING_RE.sub(' ', data)
+        if self.inheading:
+            self.headingbuf += data
+        else:
+            self._append(data)
+
+    def handle_entityref(self, name):
+        self.handle_data(self.unescape('&%s;' % (name,)))
+
+    def handle_charref(self, name):
+        self.handle_data(self.unescape('&#%s;' % (name,)))
+
+def run(parser_class, pages, repeat):
+    """Parse each page repeat times, returning the best total time and the
+    output (text and links) for each page."""
+    best = None
+    for i in range(repeat):
+        results = []
+        start = time.time()
+        for page in pages:
+            parser = parser_class()
+            parser.feed(page)
+            results.append((parser.buffer, parser.links))
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, results
+
+def fetch(directory, titles):
+    """Save the rendered HTML of English Wikipedia articles by title."""
+    for title in titles:
+        url = wikipedia.api_url('en.wikipedia.org', 'title', title)
+        body = httpclient.get(url, {'User-Agent': wikipedia.USER_AGENT},
+                              timeout=wikipedia.TIMEOUT)
+        info = {}
+        html = u''.join(wikipedia.parse_response([body.decode('utf-8')], info))
+        if 'error' in info:
+            print "%s: %s" % (title, info['error'].get('info'))
+            continue
+        filename = os.path.join(directory,
+                                title.replace('/', '_') + '.html')
+        with codecs.open(filename, 'w', 'utf-8') as outfh:
+            outfh.write(html)
+        print "%s: %d characters" % (filename, len(html))
+
+def _main(argv):
+    if len(argv) > 2 and argv[0] == '--fetch':
+        fetch(argv[1], argv[2:])
+        return
+    repeat = 5
+    if len(argv) > 1 and argv[0] == '--repeat':
+        repeat = int(argv[1])
+        argv = argv[2:]
+    if not argv:
+        sys.stderr.write(__doc__.strip().split('\n\n')[-1] + '\n')
+        sys.exit(1)
+    pages = []
+    for filename in argv:
+        with open(filename) as infh:
+            pages.append(infh.read().decode('utf-8', errors='replace'))
+    size = sum(len(page) for page in pages)
+    print "%d pages, %d characters, best of %d" % (len(pages), size, repeat)
+
+    old_time, old_results = run(ReferenceTextifier, pages, repeat)
+    new_time, new_results = run(wikipedia.WikipediaTextifier, pages, repeat)
+    for filename, old, new in zip(argv, old_results, new_results):
+        if old != new:
+            print "%s: Output differs!" % (filename,)
+            sys.exit(1)
+    print "Reference:  %.3f s" % (old_time,)
+    print "Textifier:  %.3f s (%.2fx)" % (new_time, old_time / new_time)
+
+if __name__ == '__main__':
+    _main(sys.argv[1:])
@@ -0,0 +1,133 @@
+"""
+Persistent cache for results from upstream APIs, stored in SQLite.
+"""
+
+import sqlite3
+import json
+import zlib
+from time import time
+from threading import Lock
+
+COLUMNS = ('key', 'value', 'revision', 'expires', 'accessed', 'size')
+
+class Cache(object):
+    """Key-value cache stored in a table of an SQLite database. Each entry
+    has its own expiration time, and the least recently used entries are
+    evicted when there are more than max_entries or the stored values
+    take up more than max_bytes. Values may be stored compressed.
+
+    Entries may also record a revision identifier for the upstream data,
+    so that expired entries can be revalidated rather than downloaded
+    again.
+
+    A Cache may be shared between threads."""
+
+    def __init__(self, dbfile, table, max_entries=None, max_bytes=None,
+                 compress=False):
+        self.table = table
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.compress = compress
+        self.lock = Lock()
+        self.dbh = sqlite3.connect(dbfile, check_same_thread=False)
+        # This is only a cache: if the table is from an older version,
+        # throw it away.
+        columns = tuple(row[1] for row in self.dbh.execute(
+            "PRAGMA table_info({0})".format(table)))
+        if columns and columns != COLUMNS:
+            self.dbh.execute("DROP TABLE {0}".format(table))
+        self.dbh.execute(("CREATE TABLE IF NOT EXISTS {0} (" +
+                          "key TEXT NOT NULL PRIMARY KEY, value BLOB, " +
+                          "revision TEXT, expires REAL, accessed REAL, " +
+                          "size INTEGER)")
+                         .format(table))
+        self.dbh.execute(("CREATE INDEX IF NOT EXISTS {0}_accessed " +
+                          "ON {0} (accessed)").format(table))
+        self.dbh.commit()
+
+    def get(self, key):
+        """Return the value stored for key, or None if the key is missing or
+        its entry has expired."""
+        entry = self.lookup(key)
+        if entry is None or entry[2]:
+            return None
+        return entry[0]
+
+    def lookup(self, key):
+        """Return a tuple (value, revision, expired) for the entry stored for
+        key, even if it has expired, or None if there is no entry."""
+        now = time()
+        with self.lock:
+            dbc = self.dbh.cursor()
+            dbc.execute("SELECT value, revision, expires FROM {0} WHERE key=?"
+                        .format(self.table), [key])
+            row = dbc.fetchone()
+            if not row:
+                return None
+            dbc.execute("UPDATE {0} SET accessed=? WHERE key=?"
+                        .format(self.table), [now, key])
+            self.dbh.commit()
+        return self._decode(row[0]), row[1], row[2] <= now
+
+    def put(self, key, value, ttl, revision=None):
+        """Store a (JSON-serializable) value for key, to expire after ttl
+        seconds."""
+        now = time()
+        data = self._encode(value)
+        with self.lock:
+            dbc = self.dbh.cursor()
+            dbc.execute(("INSERT OR REPLACE INTO {0} (key, value, " +
+                         "revision, expires, accessed, size) " +
+                         "VALUES (?, ?, ?, ?, ?, ?)").format(self.table),
+                        [key, data, revision, now + ttl, now, len(data)])
+            if self.max_entries or self.max_bytes:
+                self._evict(dbc)
+            self.dbh.commit()
+
+    def touch(self, key, ttl):
+        """Extend the lifetime of an entry which has been revalidated."""
+        now = time()
+        with self.lock:
+            self.dbh.execute(("UPDATE {0} SET expires=?, accessed=? " +
+                              "WHERE key=?").format(self.table),
+                             [now + ttl, now, key])
+            self.dbh.commit()
+
+    def _encode(self, value):
+        """Serialize (and maybe compress) a value for storage."""
+        data = json.dumps(value)
+        if self.compress:
+            return sqlite3.Binary(zlib.compress(data))
+        return data
+
+    def _decode(self, data):
+        """Deserialize a stored value."""
+        if self.compress:
+            data = zlib.decompress(data)
+        return json.loads(data)
+
+    def _evict(self, dbc):
+        """Delete the least recently used entries until there are no more
+        than max_entries in the table and they use no more than
+        max_bytes."""
+        if self.max_entries:
+            dbc.execute("SELECT COUNT(*) FROM {0}".format(self.table))
+            excess = dbc.fetchone()[0] - self.max_entries
+            if excess > 0:
+                dbc.execute(("DELETE FROM {0} WHERE key IN (SELECT key " +
+                             "FROM {0} ORDER BY accessed LIMIT ?)")
+                            .format(self.table), [excess])
+        if self.max_bytes:
+            dbc.execute("SELECT SUM(size) FROM {0}".format(self.table))
+            excess = (dbc.fetchone()[0] or 0) - self.max_bytes
+            victims = []
+            if excess > 0:
+                dbc.execute("SELECT key, size FROM {0} ORDER BY accessed"
+                            .format(self.table))
+                for key, size in dbc:
+                    victims.append((key,))
+                    excess -= size
+                    if excess <= 0:
+                        break
+                dbc.executemany("DELETE FROM {0} WHERE key=?"
+                                .format(self.table), victims)
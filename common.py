@@ -1,15 +1,113 @@
 from time import time, sleep
+from threading import Lock
+from multiprocessing.pool import ThreadPool
 
 class RateLimit(object):
-    """Rate-limit requests to an API."""
+    """Rate-limit requests to an API with a token bucket: up to burst
+    requests may be made at once, and the bucket refills at one request
+    per interval seconds. Safe to share between threads."""
 
-    def __init__(self, interval):
-        self.last_access = 0
+    def __init__(self, interval, burst=1):
+        self.lock = Lock()
         self.interval = interval
+        self.burst = burst
+        self.tokens = float(burst)
+        self.last_update = time()
+        # Statistics
+        self.waits = 0
+        self.wait_time = 0.0
+
+    def configure(self, interval, burst=1):
+        """Change the rate and burst size of the limit."""
+        with self.lock:
+            self._refill(time())
+            self.interval = interval
+            self.burst = burst
+            self.tokens = min(self.tokens, float(burst))
+
+    def _refill(self, now):
+        """Add tokens for the time elapsed since the last update."""
+        if self.interval > 0:
+            self.tokens = min(float(self.burst), self.tokens +
+                              (now - self.last_update) / self.interval)
+        else:
+            self.tokens = float(self.burst)
+        self.last_update = now
+
+    def try_acquire(self):
+        """Take a token if one is available right now. Return True if the
+        request may proceed, or False if it would have to wait."""
+        with self.lock:
+            self._refill(time())
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
 
     def wait(self):
-        """Wait until the given interval has passed since the last call."""
-        time_delta = self.last_access + self.interval - time()
+        """Take a token, waiting until one is available. Waiting callers
+        reserve tokens in the order they arrive."""
+        with self.lock:
+            self._refill(time())
+            self.tokens -= 1
+            time_delta = -self.tokens * self.interval
+            if time_delta > 0:
+                self.waits += 1
+                self.wait_time += time_delta
         if time_delta > 0:
             sleep(time_delta)
-        self.last_access = time()
+
+_RATELIMITS = {}
+_RATELIMITS_LOCK = Lock()
+
+def host_ratelimit(host, interval, burst=1):
+    """Return the RateLimit shared by all requests to a host, creating it
+    with the given interval and burst size if it does not exist yet."""
+    with _RATELIMITS_LOCK:
+        if host not in _RATELIMITS:
+            _RATELIMITS[host] = RateLimit(interval, burst)
+        return _RATELIMITS[host]
+
+def configure_ratelimit(host, interval, burst=1):
+    """Set the interval and burst size of the RateLimit for a host."""
+    with _RATELIMITS_LOCK:
+        if host in _RATELIMITS:
+            _RATELIMITS[host].configure(interval, burst)
+        else:
+            _RATELIMITS[host] = RateLimit(interval, burst)
+
+def ratelimit_stats():
+    """Return (host, waits, wait_time) for each host's RateLimit."""
+    with _RATELIMITS_LOCK:
+        return [(host, limit.waits, limit.wait_time)
+                for host, limit in sorted(_RATELIMITS.items())]
+
+# Number of threads running lookups started with run_async, unless changed
+# by configure_async.
+ASYNC_WORKERS = 4
+
+_POOL = None
+_POOL_LOCK = Lock()
+
+def configure_async(workers):
+    """Set the number of threads running lookups started with run_async."""
+    global _POOL, ASYNC_WORKERS
+    with _POOL_LOCK:
+        ASYNC_WORKERS = workers
+        if _POOL:
+            _POOL.close()       # Let lookups already started finish
+            _POOL = None
+
+def run_async(func, *args, **kwargs):
+    """Start a lookup, func(*args, **kwargs), on a thread pool shared by
+    the upstream interfaces, and return an AsyncResult whose get() method
+    waits for the result (or raises the exception). The lookup goes
+    through the same host_ratelimit limits as a direct call.
+
+    func must not wait on another lookup started with run_async, or the
+    pool could be used up by lookups waiting for each other."""
+    global _POOL
+    with _POOL_LOCK:
+        if not _POOL:
+            _POOL = ThreadPool(ASYNC_WORKERS)
+        return _POOL.apply_async(func, args, kwargs)
@@ -4,13 +4,15 @@ Python interface to the Freebase MQL API
 """
 
 import json
-import urllib2
 import urllib
 
-import common, wikipedia
+import common, httpclient, wikipedia
 
 USER_AGENT = 'MovieGuide-freebaseapi/0.1'
 
+# Timeouts for connecting to the API and reading from it, in seconds.
+TIMEOUT = (10, 60)
+
 # Run queries interactively at http://www.freebase.com/query
 QUERY = [{
         "/award/award_winning_work/awards_won": [{
@@ -101,7 +103,7 @@ class FreebaseTopic(object):
 class FreebaseAPI(object):
     """Interface to the Freebase MQL API"""
 
-    ratelimit = common.RateLimit(1)
+    ratelimit = common.host_ratelimit('www.googleapis.com', 1)
     key = None
 
     def __init__(self, key=None):
@@ -123,9 +125,7 @@ class FreebaseAPI(object):
 
         # Request results
         headers = {'User-Agent': USER_AGENT}
-        req = urllib2.Request(url, None, headers)
-        response = urllib2.urlopen(req, timeout=8*60)
-        data = response.read()
+        data = httpclient.get(url, headers, timeout=TIMEOUT)
 
         # Parse and return response
         obj = json.loads(data)
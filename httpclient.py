@@ -0,0 +1,275 @@
+"""
+Shared HTTP client for requests to upstream APIs and the backup server.
+
+Connections are kept alive in a pool for each host, responses compressed
+with gzip are decompressed as they are read, and redirects are followed.
+Proxies are taken from the environment (as urllib2 does) unless one is
+configured with set_proxy.
+"""
+
+import httplib
+import socket
+import threading
+import urllib
+import urlparse
+import base64
+import zlib
+
+# Default timeouts, in seconds: (connecting, each read from the socket).
+TIMEOUT = (10, 60)
+
+# Maximum number of redirects followed for one request.
+MAX_REDIRECTS = 5
+
+# Maximum number of idle connections kept open to each host.
+MAX_IDLE = 4
+
+REDIRECT_CODES = (301, 302, 303, 307, 308)
+
+class HTTPError(Exception):
+    """Exception for error responses (4xx and 5xx)."""
+    def __init__(self, url, code, reason, body=''):
+        Exception.__init__(self)
+        self.url = url
+        self.code = code
+        self.reason = reason
+        self.body = body
+    def __str__(self):
+        return 'HTTP Error %d: %s (%s)' % (self.code, self.reason, self.url)
+
+class ConnectionPool(object):
+    """Idle connections to one host (possibly through a proxy). Safe to
+    share between threads."""
+
+    def __init__(self, scheme, host, port, proxy=None):
+        self.scheme = scheme
+        self.host = host
+        self.port = port
+        self.proxy = proxy
+        self.lock = threading.Lock()
+        self.idle = []
+
+    def get(self, timeout):
+        """Return an idle connection, or a new one, and whether it has
+        been used before."""
+        with self.lock:
+            if self.idle:
+                conn = self.idle.pop()
+                conn.sock.settimeout(timeout[1])
+                return conn, True
+        return self._connect(timeout), False
+
+    def put(self, conn):
+        """Keep a connection whose response has been read, for reuse."""
+        with self.lock:
+            if len(self.idle) < MAX_IDLE:
+                self.idle.append(conn)
+                return
+        conn.close()
+
+    def _connect(self, timeout):
+        """Open a connection to the host, or to the proxy."""
+        if self.proxy and self.scheme == 'http':
+            # Plain HTTP requests are sent to the proxy with the full URL
+            conn = httplib.HTTPConnection(self.proxy.hostname,
+                                          self.proxy.port, timeout=timeout[0])
+        elif self.proxy:
+            # HTTPS requests are tunneled through the proxy
+            conn = httplib.HTTPSConnection(self.proxy.hostname,
+                                           self.proxy.port, timeout=timeout[0])
+            conn.set_tunnel(self.host, self.port,
+                            proxy_headers(self.proxy))
+        elif self.scheme == 'https':
+            conn = httplib.HTTPSConnection(self.host, self.port,
+                                           timeout=timeout[0])
+        else:
+            conn = httplib.HTTPConnection(self.host, self.port,
+                                          timeout=timeout[0])
+        conn.connect()
+        conn.sock.settimeout(timeout[1])
+        return conn
+
+def basic_auth(auth):
+    """Return an Authorization header value for a (username, password)."""
+    return 'Basic ' + base64.b64encode('%s:%s' % auth)
+
+def proxy_headers(proxy):
+    """Return the headers to send to a proxy (for its credentials)."""
+    if proxy.username is None:
+        return {}
+    return {'Proxy-Authorization':
+            basic_auth((urllib.unquote(proxy.username),
+                        urllib.unquote(proxy.password or '')))}
+
+class Response(object):
+    """File-like response to a request, which decompresses the body if
+    needed. The connection is returned to its pool when the whole body has
+    been read, or closed if the response is closed early."""
+
+    def __init__(self, url, response, conn, pool):
+        self.url = url
+        self.status = response.status
+        self.reason = response.reason
+        self._response = response
+        self._conn = conn
+        self._pool = pool
+        self._decompressor = None
+        if (response.getheader('content-encoding') or '').lower() == 'gzip':
+            self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def getheader(self, name, default=None):
+        """Return the value of a response header."""
+        return self._response.getheader(name, default)
+
+    def getcode(self):
+        """Return the status code, like urllib2 responses."""
+        return self.status
+
+    def read(self, size=-1):
+        """Read (up to size bytes, if given) of the decompressed body."""
+        if not self._conn:
+            return ''
+        if size is None or size < 0:
+            data = self._response.read()
+            if self._decompressor:
+                data = self._decompressor.decompress(data) + \
+                    self._decompressor.flush()
+            self._done()
+            return data
+        while True:
+            chunk = self._response.read(size)
+            if not chunk:
+                data = self._decompressor.flush() if self._decompressor \
+                    else ''
+                self._done()
+                return data
+            if not self._decompressor:
+                return chunk
+            data = self._decompressor.decompress(chunk)
+            if data:
+                return data
+
+    def _done(self):
+        """Release the connection when the body has been read."""
+        if self._response.isclosed() and not self._response.will_close:
+            self._pool.put(self._conn)
+        else:
+            self._conn.close()
+        self._conn = None
+
+    def close(self):
+        """Close the response, and the connection if the body has not been
+        read."""
+        if self._conn:
+            self._conn.close()
+            self._conn = None
+
+class Client(object):
+    """HTTP client with a connection pool for each host."""
+
+    def __init__(self, proxy=None):
+        self.lock = threading.Lock()
+        self.pools = {}
+        self.proxy = proxy
+
+    def set_proxy(self, proxy):
+        """Use a proxy (URL) for all requests, or none if proxy is '', or
+        the proxies from the environment if proxy is None."""
+        with self.lock:
+            self.proxy = proxy
+            self.pools = {}
+
+    def _pool(self, parts):
+        """Return the pool for the host of a URL."""
+        proxy = self.proxy
+        if proxy is None and not urllib.proxy_bypass(parts.hostname):
+            proxy = urllib.getproxies().get(parts.scheme)
+        proxy = urlparse.urlsplit(proxy) if proxy else None
+        port = parts.port or (443 if parts.scheme == 'https' else 80)
+        key = (parts.scheme, parts.hostname, port, proxy)
+        with self.lock:
+            if key not in self.pools:
+                self.pools[key] = ConnectionPool(parts.scheme, parts.hostname,
+                                                 port, proxy)
+            return self.pools[key]
+
+    def request(self, method, url, data=None, headers=None, auth=(),
+                timeout=TIMEOUT, compress=True):
+        """Make a request, following redirects, and return a Response. data
+        may be a string, or an iterable of chunks to send with chunked
+        transfer encoding. Raises HTTPError for error responses."""
+        for i in range(MAX_REDIRECTS + 1):
+            response = self._request(method, url, data, headers, auth,
+                                     timeout, compress)
+            location = response.getheader('location')
+            if response.status not in REDIRECT_CODES or not location or \
+                    (data is not None and response.status != 303):
+                break
+            response.read()
+            url = urlparse.urljoin(url, location)
+            if response.status == 303:
+                method, data = 'GET', None
+        if response.status >= 400:
+            raise HTTPError(url, response.status, response.reason,
+                            response.read())
+        return response
+
+    def _request(self, method, url, data, headers, auth, timeout, compress):
+        """Make one request, on a kept-alive connection if possible."""
+        parts = urlparse.urlsplit(url)
+        pool = self._pool(parts)
+        if pool.proxy and parts.scheme == 'http':
+            path = url
+        else:
+            path = (parts.path or '/') + \
+                ('?' + parts.query if parts.query else '')
+        headers = dict(headers or {})
+        if compress:
+            headers.setdefault('Accept-Encoding', 'gzip')
+        if auth:
+            headers['Authorization'] = basic_auth(auth)
+        if pool.proxy and parts.scheme == 'http':
+            headers.update(proxy_headers(pool.proxy))
+
+        while True:
+            conn, reused = pool.get(timeout)
+            try:
+                if data is None or isinstance(data, str):
+                    conn.request(method, path, data, headers)
+                else:
+                    # Send the chunks as they are generated
+                    conn.putrequest(method, path, skip_accept_encoding=True)
+                    for name, value in headers.items():
+                        conn.putheader(name, value)
+                    conn.putheader('Transfer-Encoding', 'chunked')
+                    conn.endheaders()
+                    for chunk in data:
+                        if chunk:
+                            conn.send('%x\r\n%s\r\n' % (len(chunk), chunk))
+                    conn.send('0\r\n\r\n')
+                return Response(url, conn.getresponse(), conn, pool)
+            except (httplib.HTTPException, socket.error):
+                conn.close()
+                # The server may have closed an idle connection: try again
+                # on a new one, if the body can be sent again.
+                if not reused or not (data is None or isinstance(data, str)):
+                    raise
+
+_CLIENT = Client()
+
+def request(method, url, data=None, headers=None, auth=(), timeout=TIMEOUT,
+            compress=True):
+    """Make a request with the shared Client and return a Response."""
+    return _CLIENT.request(method, url, data, headers, auth, timeout,
+                           compress)
+
+def get(url, headers=None, timeout=TIMEOUT):
+    """Request a URL with the shared Client and return the body."""
+    response = request('GET', url, headers=headers, timeout=timeout)
+    data = response.read()
+    response.close()
+    return data
+
+def set_proxy(proxy):
+    """Set the proxy used by the shared Client (see Client.set_proxy)."""
+    _CLIENT.set_proxy(proxy)
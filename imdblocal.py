@@ -0,0 +1,483 @@
+#!/usr/bin/env python
+"""
+In-process IMDb search over the IMDb datasets (https://datasets.imdbws.com/),
+as an alternative to the JSON API used by jsonapi.IMDbAPI.
+
+Usage: imdblocal.py build DATASETS_DIRECTORY imdb-index.db
+       imdblocal.py search imdb-index.db TITLE [YEAR]
+       imdblocal.py serve imdb-index.db [PORT]
+
+The index is an SQLite database, read with memory-mapped I/O. Titles are
+numbered in order of year, so each year is a range of document numbers,
+and the postings for each trigram of the normalized titles are a sorted
+array of document numbers which can be cut to a range of years by
+bisection.
+
+The index can also be served over HTTP, as a stand-in for the JSON API
+used by jsonapi.IMDbAPI (including batch requests).
+"""
+
+from array import array
+from bisect import bisect_left
+from collections import defaultdict
+import heapq
+from gzip import GzipFile
+from threading import Lock
+import json
+import math
+import os
+import re
+import sqlite3
+import sys
+import unicodedata
+import urlparse
+from wsgiref.simple_server import make_server
+
+import common, jsonapi
+
+# Types of titles which are indexed (not episodes, games, etc.), and
+# suffixes IMDb uses for them in titles. Series are quoted.
+TITLE_TYPES = {'movie': '', 'short': '', 'tvMovie': ' (TV)',
+               'tvSpecial': ' (TV)', 'video': ' (V)', 'tvSeries': '',
+               'tvMiniSeries': ''}
+SERIES_TYPES = ('tvSeries', 'tvMiniSeries')
+
+# Number of cast members kept for each title.
+CAST_LIMIT = 15
+CAST_CATEGORIES = ('actor', 'actress', 'self')
+
+# Number of rows written at once while building.
+BATCH_SIZE = 10000
+
+# Searching: the fraction of the query's trigrams a title must share, the
+# number of candidates scored exactly, and the lowest score accepted.
+MIN_OVERLAP = 0.5
+MAX_CANDIDATES = 50
+MIN_SCORE = 0.5
+# Score multipliers for titles a year off, of the wrong kind (series or
+# not), and the weight of the number of votes (to break ties).
+YEAR_OFF_FACTOR = 0.9
+KIND_FACTOR = 0.9
+VOTES_WEIGHT = 0.001
+
+# Memory-mapped size of the index when it is read.
+MMAP_SIZE = 1024*1024*1024
+
+# Port and path the index is served on, like the JSON API, and the largest
+# batch request accepted.
+SERVE_PORT = 8051
+SERVE_PATH = '/imdb'
+MAX_BATCH_BYTES = 1024*1024
+
+NONWORD_RE = re.compile(r'[\W_]+', flags=re.UNICODE)
+
+def normalize(title):
+    """Normalize a title for searching: lowercase, without accents or
+    punctuation."""
+    title = unicodedata.normalize('NFKD', unicode(title).lower())
+    title = u''.join(c for c in title if not unicodedata.combining(c))
+    return NONWORD_RE.sub(u' ', title).strip()
+
+def trigrams(norm):
+    """Return the set of trigrams of a normalized title."""
+    padded = u'  %s ' % (norm,)
+    return set(padded[i:i+3] for i in xrange(len(padded) - 2))
+
+def read_tsv(directory, name):
+    """Read the rows of a (gzipped) IMDb dataset, with \\N as None."""
+    infh = GzipFile(os.path.join(directory, name + '.tsv.gz'))
+    try:
+        header = infh.readline().rstrip('\n').split('\t')
+        for line in infh:
+            row = line.rstrip('\n').split('\t')
+            if len(row) != len(header):
+                continue
+            yield [None if i == '\\N' else i.decode('utf-8') for i in row]
+    finally:
+        infh.close()
+
+def _load(dbh, statement, rows):
+    """Run an INSERT statement for rows, a batch at a time."""
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= BATCH_SIZE:
+            dbh.executemany(statement, batch)
+            del batch[:]
+    dbh.executemany(statement, batch)
+    dbh.commit()
+
+STAGING = (
+    "CREATE TABLE basics (tconst TEXT NOT NULL PRIMARY KEY, type TEXT, "
+    "primary_title TEXT, original_title TEXT, year INTEGER, runtime INTEGER, "
+    "genres TEXT) WITHOUT ROWID",
+    "CREATE TABLE ratings (tconst TEXT NOT NULL PRIMARY KEY, rating TEXT, "
+    "votes INTEGER) WITHOUT ROWID",
+    "CREATE TABLE crew (tconst TEXT NOT NULL PRIMARY KEY, directors TEXT, "
+    "writers TEXT) WITHOUT ROWID",
+    "CREATE TABLE principals (tconst TEXT NOT NULL, ordering INTEGER, "
+    "nconst TEXT, characters TEXT, PRIMARY KEY (tconst, ordering)) "
+    "WITHOUT ROWID",
+    "CREATE TABLE needed (nconst TEXT NOT NULL PRIMARY KEY) WITHOUT ROWID",
+    "CREATE TABLE names (nconst TEXT NOT NULL PRIMARY KEY, name TEXT) "
+    "WITHOUT ROWID",
+)
+SCHEMA = (
+    "CREATE TABLE doc (docid INTEGER NOT NULL PRIMARY KEY, norm TEXT, "
+    "aka TEXT, year INTEGER, series INTEGER, votes INTEGER, record TEXT)",
+    "CREATE TABLE gram (gram TEXT NOT NULL PRIMARY KEY, postings BLOB) "
+    "WITHOUT ROWID",
+    "CREATE TABLE year (year INTEGER NOT NULL PRIMARY KEY, first INTEGER, "
+    "last INTEGER)",
+    "CREATE TABLE exact (norm TEXT NOT NULL, docid INTEGER NOT NULL, "
+    "PRIMARY KEY (norm, docid)) WITHOUT ROWID",
+    "CREATE TABLE popularity (votes BLOB)",
+)
+
+def build_index(directory, indexfile):
+    """Build a search index from the IMDb datasets in a directory. Large
+    tables are staged in the index file rather than kept in memory; only
+    the trigram postings are collected in memory."""
+    tempfile = indexfile + '.part'
+    if os.path.exists(tempfile):
+        os.remove(tempfile)
+    dbh = sqlite3.connect(tempfile)
+    dbh.execute("PRAGMA journal_mode=OFF")
+    dbh.execute("PRAGMA synchronous=OFF")
+    for statement in STAGING + SCHEMA:
+        dbh.execute(statement)
+
+    # Stage the datasets, keeping only the rows for indexed titles
+    print "Loading titles..."
+    _load(dbh, "INSERT INTO basics VALUES (?, ?, ?, ?, ?, ?, ?)",
+          (row[0:4] + [row[5], row[7], row[8]] for row
+           in read_tsv(directory, 'title.basics') if row[1] in TITLE_TYPES))
+    exists = " WHERE EXISTS (SELECT 1 FROM basics WHERE tconst=?)"
+    print "Loading ratings..."
+    _load(dbh, "INSERT INTO ratings SELECT ?, ?, ?" + exists,
+          (row + [row[0]] for row in read_tsv(directory, 'title.ratings')))
+    print "Loading crew..."
+    _load(dbh, "INSERT INTO crew SELECT ?, ?, ?" + exists,
+          (row + [row[0]] for row in read_tsv(directory, 'title.crew')))
+    print "Loading principals..."
+    _load(dbh, "INSERT INTO principals SELECT ?, ?, ?, ?" + exists,
+          ([row[0], int(row[1]), row[2], row[5], row[0]] for row
+           in read_tsv(directory, 'title.principals')
+           if row[3] in CAST_CATEGORIES and int(row[1]) <= CAST_LIMIT))
+    print "Loading names..."
+    dbh.execute("INSERT OR IGNORE INTO needed SELECT nconst FROM principals")
+    _load(dbh, "INSERT OR IGNORE INTO needed VALUES (?)",
+          ([nconst] for row in dbh.execute("SELECT directors, writers "
+                                           "FROM crew").fetchall()
+           for field in row if field for nconst in field.split(',')))
+    _load(dbh, "INSERT INTO names SELECT ?, ?" +
+          " WHERE EXISTS (SELECT 1 FROM needed WHERE nconst=?)",
+          (row[0:2] + [row[0]] for row in read_tsv(directory, 'name.basics')))
+
+    # Number the titles in order of year, and build the records
+    print "Indexing titles..."
+    postings = defaultdict(lambda: array('I'))
+    popularity = array('I')
+    years = {}
+    docs, exact = [], []
+    docid = -1
+    names = dbh.cursor()
+    def _names(field):
+        """Look up a comma-separated list of people."""
+        result = []
+        for nconst in (field or '').split(',')[:CAST_LIMIT]:
+            row = names.execute("SELECT name FROM names WHERE nconst=?",
+                                [nconst]).fetchone()
+            if row:
+                result.append([row[0]])
+        return result
+    rows = dbh.cursor().execute(
+        "SELECT tconst, type, primary_title, original_title, year, " +
+        "runtime, genres, rating, votes, directors, writers FROM basics " +
+        "LEFT JOIN ratings USING (tconst) LEFT JOIN crew USING (tconst) " +
+        "ORDER BY year, tconst")
+    for docid, row in enumerate(rows):
+        (tconst, ttype, primary, original, year, runtime, genres, rating,
+         votes, directors, writers) = row
+        year = int(year) if year else 0
+        if year not in years:
+            years[year] = [docid, docid]
+        years[year][1] = docid + 1
+
+        cast = []
+        for name, characters in names.execute(
+                "SELECT name, characters FROM principals " +
+                "LEFT JOIN names USING (nconst) WHERE tconst=? " +
+                "ORDER BY ordering", [tconst]).fetchall():
+            roles = json.loads(characters) if characters else []
+            cast.append([name, roles[0] if roles else None])
+        title = primary
+        if ttype in SERIES_TYPES:
+            title = u'"%s"' % (title,)
+        title += u' (%s)%s' % (year or '????', TITLE_TYPES[ttype])
+        record = {'title': title, 'imdbid': tconst,
+                  'rating': [None, int(votes or 0), rating or 0],
+                  'plot': None, 'certificates': None,
+                  'running_time': int(runtime) if runtime else None,
+                  'genres': genres.split(',') if genres else [],
+                  'cast': cast, 'directors': _names(directors),
+                  'writers': _names(writers)}
+
+        # Index both the title and the original title
+        norm = normalize(primary)
+        aka = normalize(original) if original and original != primary \
+            else None
+        grams = trigrams(norm) | (trigrams(aka) if aka else set())
+        for gram in grams:
+            postings[gram].append(docid)
+        popularity.append(int(votes or 0))
+        exact.extend((n, docid) for n in set((norm, aka)) if n)
+        docs.append((docid, norm, aka and original, year,
+                     int(ttype in SERIES_TYPES), int(votes or 0),
+                     json.dumps(record)))
+        if len(docs) >= BATCH_SIZE:
+            dbh.executemany("INSERT INTO doc VALUES (?, ?, ?, ?, ?, ?, ?)",
+                            docs)
+            dbh.executemany("INSERT INTO exact VALUES (?, ?)", exact)
+            del docs[:], exact[:]
+            sys.stdout.write("\r%d titles" % (docid + 1,))
+            sys.stdout.flush()
+    dbh.executemany("INSERT INTO doc VALUES (?, ?, ?, ?, ?, ?, ?)", docs)
+    dbh.executemany("INSERT INTO exact VALUES (?, ?)", exact)
+    dbh.execute("INSERT INTO popularity VALUES (?)",
+                [sqlite3.Binary(popularity.tostring())])
+    sys.stdout.write("\r%d titles\n" % (docid + 1,))
+
+    _load(dbh, "INSERT INTO gram VALUES (?, ?)",
+          ((gram, sqlite3.Binary(docids.tostring()))
+           for gram, docids in postings.iteritems()))
+    _load(dbh, "INSERT INTO year VALUES (?, ?, ?)",
+          ((year, first, last) for year, (first, last) in years.iteritems()))
+    for table in ('basics', 'ratings', 'crew', 'principals', 'needed',
+                  'names'):
+        dbh.execute("DROP TABLE %s" % (table,))
+    dbh.commit()
+    dbh.execute("VACUUM")
+    dbh.close()
+    os.rename(tempfile, indexfile)
+
+class IMDbLocal(object):
+    """Search an index built by build_index, with the same interface as
+    jsonapi.IMDbAPI. May be shared between threads."""
+
+    def __init__(self, indexfile):
+        if not os.path.exists(indexfile):
+            raise IOError("No such index: %s" % (indexfile,))
+        self.lock = Lock()
+        self.dbh = sqlite3.connect(indexfile, check_same_thread=False)
+        self.dbh.execute("PRAGMA query_only=ON")
+        self.dbh.execute("PRAGMA mmap_size=%d" % (MMAP_SIZE,))
+        self.years = dict((row[0], (row[1], row[2])) for row in
+                          self.dbh.execute("SELECT * FROM year"))
+        self.size = max([last for first, last in self.years.values()] or [0])
+        # Number of votes for each title, to rank candidates
+        self.votes = array('I')
+        try:
+            self.votes.fromstring(str(self.dbh.execute(
+                "SELECT votes FROM popularity").fetchone()[0]))
+        except sqlite3.OperationalError:
+            raise IOError("Index %s is out of date: rebuild it" %
+                          (indexfile,))
+
+    def search(self, query, year=None):
+        """Search for a title (in quotes, to prefer series) and return the
+        best match, like IMDbAPI.search."""
+        obj = self._search(query, year)
+        if 'title' in obj and '_score' in obj:
+            return obj
+        raise jsonapi.IMDbError(obj['_error'], obj)
+
+    def search_async(self, query, year=None):
+        """Start a search on the shared lookup pool, returning an
+        AsyncResult for the result of search."""
+        return common.run_async(self.search, query, year)
+
+    def search_many(self, items):
+        """Search for a list of (query, year), returning a list with the
+        result of each, or the IMDbError it raised, like
+        IMDbAPI.search_many."""
+        results = []
+        for query, year in items:
+            try:
+                results.append(self.search(query, year))
+            except jsonapi.IMDbError as err:
+                results.append(err)
+        return results
+
+    def _docrange(self, year):
+        """Return the range of document numbers for titles within a year
+        of year (or all of them)."""
+        if not year:
+            return 0, self.size
+        ranges = [self.years[y] for y in (year - 1, year, year + 1)
+                  if y in self.years]
+        if not ranges:
+            return 0, 0
+        return min(r[0] for r in ranges), max(r[1] for r in ranges)
+
+    def _search(self, query, year=None):
+        """Find the best match for a query, returning the record with its
+        score, or an _error."""
+        query = unicode(query).strip()
+        series = query.startswith('"')
+        norm = normalize(query)
+        grams = trigrams(norm) if norm else set()
+        if not grams:
+            return {'_error': 'Empty query'}
+        year = int(year) if year else None
+        first, last = self._docrange(year)
+
+        with self.lock:
+            # Postings of each trigram, cut to the range of years
+            lists = []
+            for gram in grams:
+                row = self.dbh.execute("SELECT postings FROM gram "
+                                       "WHERE gram=?", [gram]).fetchone()
+                docids = array('I')
+                if row:
+                    docids.fromstring(str(row[0]))
+                lists.append(docids[bisect_left(docids, first):
+                                    bisect_left(docids, last)])
+
+            # A title sharing enough trigrams must contain one of the
+            # rarest few, so only those are read in full
+            lists.sort(key=len)
+            needed = max(1, int(math.ceil(len(grams) * MIN_OVERLAP)))
+            counts = defaultdict(int)
+            for docids in lists[:len(grams) - needed + 1]:
+                for docid in docids:
+                    counts[docid] += 1
+
+            # Keep the candidates with the most of those trigrams, breaking
+            # ties by exact match, then year, then votes
+            exact = set(row[0] for row in self.dbh.execute(
+                "SELECT docid FROM exact WHERE norm=? AND docid>=? AND " +
+                "docid<?", [norm, first, last]))
+            tiers = defaultdict(list)
+            for docid, count in counts.iteritems():
+                tiers[count].append(docid)
+            candidates = []
+            for count in sorted(tiers, reverse=True):
+                wanted = MAX_CANDIDATES - len(candidates)
+                if wanted <= 0:
+                    break
+                candidates.extend(self._rank(tiers[count], wanted, exact,
+                                             year))
+            if not candidates:
+                return {'_error': 'No match'}
+            rows = self.dbh.execute(
+                "SELECT docid, norm, aka, year, series, votes FROM doc " +
+                "WHERE docid IN (%s)" % (','.join('?' * len(candidates)),),
+                candidates).fetchall()
+
+            # Score the candidates exactly
+            best = None
+            for docid, dnorm, aka, dyear, dseries, votes in rows:
+                score, matched_aka = self._similarity(grams, dnorm), None
+                if aka:
+                    aka_score = self._similarity(grams, normalize(aka))
+                    if aka_score > score:
+                        score, matched_aka = aka_score, aka
+                if year and dyear != year:
+                    score *= YEAR_OFF_FACTOR
+                if bool(dseries) != series:
+                    score *= KIND_FACTOR
+                key = (score + VOTES_WEIGHT * math.log10(votes + 1), docid)
+                if not best or key > best[0]:
+                    best = (key, docid, score, matched_aka)
+            if best[2] < MIN_SCORE:
+                return {'_error': 'No match'}
+            record = self.dbh.execute("SELECT record FROM doc WHERE docid=?",
+                                      [best[1]]).fetchone()[0]
+
+        obj = json.loads(record)
+        obj['_score'] = round(best[2], 4)
+        if best[3]:
+            obj['aka'] = best[3]
+        return obj
+
+    def _rank(self, docids, wanted, exact, year):
+        """Pick up to wanted of docids, which share as many trigrams with
+        the query: exact matches first, then titles from the year, then
+        the titles with the most votes."""
+        if len(docids) <= wanted:
+            return docids
+        picked = list(exact.intersection(docids))[:wanted]
+        first, last = self.years.get(year, (0, 0))
+        for group in ([docid for docid in docids if first <= docid < last
+                       and docid not in exact],
+                      [docid for docid in docids if not first <= docid < last
+                       and docid not in exact]):
+            if len(picked) >= wanted:
+                break
+            picked.extend(heapq.nlargest(wanted - len(picked), group,
+                                         key=self.votes.__getitem__))
+        return picked
+
+    @staticmethod
+    def _similarity(grams, norm):
+        """Dice coefficient of the trigrams of a query and a title."""
+        other = trigrams(norm)
+        return 2.0 * len(grams & other) / (len(grams) + len(other))
+
+def make_app(index):
+    """Return a WSGI application answering queries like the JSON API: GET
+    with parameters q and y, or POST of a batch of queries (see
+    jsonapi.BATCH_UNSUPPORTED_CODES for the format)."""
+    def _year(value):
+        """Parse a year parameter, which may be missing or bad."""
+        try:
+            return int(value) if value else None
+        except ValueError:
+            return None
+
+    def app(environ, start_response):
+        """Answer one request."""
+        status = '200 OK'
+        if environ.get('PATH_INFO', '') != SERVE_PATH:
+            status, obj = '404 Not Found', {'_error': 'Not found'}
+        elif environ['REQUEST_METHOD'] == 'GET':
+            params = urlparse.parse_qs(environ.get('QUERY_STRING', ''))
+            obj = index._search(params.get('q', [''])[0].decode('utf-8'),
+                                _year(params.get('y', [None])[0]))
+        elif environ['REQUEST_METHOD'] == 'POST':
+            try:
+                length = int(environ.get('CONTENT_LENGTH') or 0)
+                if length > MAX_BATCH_BYTES:
+                    raise ValueError('Batch too large')
+                queries = json.loads(environ['wsgi.input'].read(length))
+                obj = {'results': [index._search(query['q'],
+                                                 _year(query.get('y')))
+                                   for query in queries['queries']]}
+            except (ValueError, TypeError, KeyError) as err:
+                status, obj = '400 Bad Request', {'_error': str(err)}
+        else:
+            status, obj = '405 Method Not Allowed', {'_error': 'Bad method'}
+        data = json.dumps(obj)
+        start_response(status, [('Content-Type', 'application/json'),
+                                ('Content-Length', str(len(data)))])
+        return [data]
+    return app
+
+def _main(argv):
+    if len(argv) == 3 and argv[0] == 'build':
+        build_index(argv[1], argv[2])
+    elif len(argv) in (3, 4) and argv[0] == 'search':
+        print IMDbLocal(argv[1]).search(argv[2].decode('utf-8'),
+                                        argv[3] if len(argv) > 3 else None)
+    elif len(argv) in (2, 3) and argv[0] == 'serve':
+        port = int(argv[2]) if len(argv) > 2 else SERVE_PORT
+        server = make_server('', port, make_app(IMDbLocal(argv[1])))
+        print "Serving on http://localhost:%d%s" % (port, SERVE_PATH)
+        server.serve_forever()
+    else:
+        sys.stderr.write(__doc__.strip().split('\n\n')[1] + '\n')
+        sys.exit(1)
+
+if __name__ == '__main__':
+    _main(sys.argv[1:])
@@ -4,13 +4,32 @@ Python interface to the JSON API implemented by imdb/wsgi.py
 """
 
 import json
-import urllib2
 import urllib
+import urlparse
+import re
 
-import common
+import common, httpclient
 
 USER_AGENT = 'MovieGuide-jsonapi/0.1'
 
+# Timeouts for connecting to the API and reading from it, in seconds.
+TIMEOUT = (5, 2*60)
+
+# Lifetime of cached search results, in seconds. Failed searches are
+# remembered for less time, in case the movie is added to IMDb.
+CACHE_TTL = 7*24*60*60
+CACHE_NEGATIVE_TTL = 24*60*60
+
+# Batch requests are a POST to the endpoint of a JSON object
+#   {"queries": [{"q": query, "y": year}, ...]}
+# ("y" is optional), answered with
+#   {"results": [response, ...]}
+# with the response to each query (as for a GET) in the same order. APIs
+# which answer POSTs with one of these statuses do not support batches.
+BATCH_UNSUPPORTED_CODES = (400, 404, 405, 411, 501)
+
+SPACE_RE = re.compile(r'\s+', flags=re.UNICODE)
+
 class IMDbError(Exception):
     """Exception class for module."""
     def __init__(self, error, data):
@@ -24,13 +43,82 @@ class IMDbError(Exception):
 class IMDbAPI(object):
     """Interface to the JSON API implemented by imdb/wsgi.py"""
 
-    ratelimit = common.RateLimit(1)
-
-    def __init__(self, endpoint):
+    def __init__(self, endpoint, cache=None):
         self.endpoint = endpoint
+        self.cache = cache
+        # Whether the API supports batch requests (None until tried)
+        self.batching = None
+        self.ratelimit = common.host_ratelimit(
+            urlparse.urlsplit(endpoint).hostname, 1)
+
+    @staticmethod
+    def cache_key(query, year=None):
+        """Generate a cache key from a normalized query and year."""
+        query = SPACE_RE.sub(' ', unicode(query)).strip().lower()
+        return u'%s|%s' % (query, year or '')
 
     def search(self, query, year=None):
-        """Perform a query via the API and return the results."""
+        """Perform a query via the API (or the cache, if it has a recent
+        result) and return the results."""
+
+        key = self.cache_key(query, year)
+        obj = self.cache.get(key) if self.cache else None
+        if obj is None:
+            obj = self._search(query, year)
+            self._store(key, obj)
+        return self._result(obj)
+
+    def search_many(self, items):
+        """Perform queries for a list of (query, year) at once, and return
+        a list with the results of each, or the IMDbError it raised. Queries
+        which are not cached are sent in one batch request, or one after
+        another if the API does not support batches."""
+
+        keys = [self.cache_key(query, year) for query, year in items]
+        objs = [self.cache.get(key) if self.cache else None for key in keys]
+        missing = [i for i, obj in enumerate(objs) if obj is None]
+        if missing:
+            found = None
+            if self.batching is not False:
+                found = self._search_batch([items[i] for i in missing])
+            if found is None:
+                found = [self._search(*items[i]) for i in missing]
+            for i, obj in zip(missing, found):
+                objs[i] = obj
+                self._store(keys[i], obj)
+
+        results = []
+        for obj in objs:
+            try:
+                results.append(self._result(obj))
+            except IMDbError as err:
+                results.append(err)
+        return results
+
+    def _store(self, key, obj):
+        """Cache a search result."""
+        found = 'title' in obj and '_score' in obj
+        # Remember matches and definite misses (but not garbage)
+        if self.cache and (found or '_error' in obj):
+            self.cache.put(key, obj,
+                           CACHE_TTL if found else CACHE_NEGATIVE_TTL)
+
+    @staticmethod
+    def _result(obj):
+        """Return a search result, or raise IMDbError if it is an error."""
+        if 'title' in obj and '_score' in obj:
+            return obj
+        else:
+            msg = obj['_error'] if '_error' in obj else 'Failed to parse data'
+            raise IMDbError(msg, obj)
+
+    def search_async(self, query, year=None):
+        """Start a search on the shared lookup pool, returning an
+        AsyncResult for the result of search."""
+        return common.run_async(self.search, query, year)
+
+    def _search(self, query, year=None):
+        """Perform a query via the API and return the parsed response."""
 
         self.ratelimit.wait()
 
@@ -43,26 +131,54 @@ class IMDbAPI(object):
         # Request results
         if True:
             headers = {'User-Agent': USER_AGENT}
-            req = urllib2.Request(url, None, headers)
-            response = urllib2.urlopen(req, timeout=8*60)
-            data = response.read()
+            data = httpclient.get(url, headers, timeout=TIMEOUT)
         #else:
         #    data = _SAMPLE_DATA
 
         # Parse response
-        obj = json.loads(data)
+        return self._parse(json.loads(data))
+
+    def _search_batch(self, items):
+        """Perform queries for a list of (query, year) in one request, and
+        return the parsed response for each, or None if the API does not
+        support batch requests (see BATCH_UNSUPPORTED_CODES)."""
 
+        self.ratelimit.wait()
+        queries = []
+        for query, year in items:
+            queries.append({'q': unicode(query)})
+            if year:
+                queries[-1]['y'] = str(year)
+        headers = {'User-Agent': USER_AGENT,
+                   'Content-Type': 'application/json'}
+        try:
+            response = httpclient.request('POST', self.endpoint,
+                                          json.dumps({'queries': queries}),
+                                          headers, timeout=TIMEOUT)
+            data = response.read()
+            response.close()
+            results = json.loads(data)['results']
+        except httpclient.HTTPError as err:
+            if err.code not in BATCH_UNSUPPORTED_CODES:
+                raise
+            results = None
+        except (ValueError, TypeError, KeyError):
+            results = None
+        if results is None or len(results) != len(items):
+            self.batching = False
+            return None
+        self.batching = True
+        return [self._parse(obj) for obj in results]
+
+    @staticmethod
+    def _parse(obj):
+        """Clean up a response to a query."""
         # If there are no votes, return 0 instead of N/A
         if 'imdbRating' in obj and 'imdbVotes' in obj and \
            (obj['imdbRating'] == 'N/A' or obj['imdbVotes'] == 'N/A'):
             obj['imdbRating'] = 0
             obj['imdbVotes'] = 0
-
-        if 'title' in obj and '_score' in obj:
-            return obj
-        else:
-            msg = obj['_error'] if '_error' in obj else 'Failed to parse data'
-            raise IMDbError(msg, obj)
+        return obj
 
 def _main():
     """Utility function for command-line testing."""
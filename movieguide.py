@@ -10,9 +10,13 @@ import sqlite3
 import ConfigParser
 import codecs
 import time
+import sys
+import threading
+from Queue import Queue
+from collections import deque, OrderedDict
 from datetime import datetime, date, timedelta
 
-import author, backup
+import author, backup, common, httpclient, schema_upgrade
 
 USER_AGENT = 'MovieGuide/0.2 (by /u/nandhp)'
 
@@ -174,6 +178,25 @@ class PostFlairRegExpFilter(PostFilter):
 
 DEFAULT_ERRORDELAY = 60
 
+# Maximum number of parameters to bind in one query with an IN (...)
+# clause (SQLite's default limit is 999).
+MAX_QUERY_PARAMS = 500
+
+def chunks(seq, size):
+    """Split a sequence into lists of at most size items."""
+    seq = list(seq)
+    return [seq[i:i+size] for i in xrange(0, len(seq), size)]
+
+# Number of pending posts whose lookups are prefetched together.
+PREFETCH_POSTS = 50
+
+# Seconds to wait after handling each post
+POST_DELAY = 5
+
+# When catching up to the last post seen in a subreddit, fetch at most
+# this many times the configured limit.
+CATCHUP_FACTOR = 10
+
 def parse_bool(s):
     if isinstance(s, int) or isinstance(s, bool):
         return bool(s)
@@ -185,10 +208,47 @@ def parse_bool(s):
     raise ValueError("Can't parse boolean from %s" % (s,))
 
 class IDMap(object):
-    """Helper class to map string keys to numeric values."""
+    """Helper class to map string keys to numeric values. Mappings are kept
+    in memory: preloaded columns are kept in full, and other columns keep
+    the max_cached most recently used values. The database is only
+    consulted (and written to) for values not in memory."""
 
-    def __init__(self, dbh):
+    def __init__(self, dbh, max_cached=10000):
         self.dbh = dbh
+        self.max_cached = max_cached
+        self.cache = {}
+        self.preloaded = set()
+
+    def preload(self, column):
+        """Load every mapping for a (small) column into memory."""
+        self.preloaded.add(column)
+        cache = self._column_cache(column)
+        for value, value_id in self.dbh.execute(
+                "SELECT {0}, {0}_id FROM {0}".format(column)):
+            cache[value] = value_id
+
+    def _column_cache(self, column):
+        """Return the in-memory mappings for a column."""
+        if column not in self.cache:
+            self.cache[column] = OrderedDict()
+        return self.cache[column]
+
+    def _remember(self, column, value, value_id):
+        """Store a mapping in memory, evicting the least recently used
+        mapping if there are too many."""
+        cache = self._column_cache(column)
+        cache[value] = value_id
+        if column not in self.preloaded and len(cache) > self.max_cached:
+            cache.popitem(last=False)
+
+    def _recall(self, column, value):
+        """Return a mapping from memory (or None), marking it recently
+        used."""
+        cache = self._column_cache(column)
+        value_id = cache.pop(value, None)
+        if value_id is not None:
+            cache[value] = value_id
+        return value_id
 
     def lookup(self, column, value):
         """Lookup the numeric value associated with the given string value for
@@ -196,6 +256,9 @@ class IDMap(object):
 
         if value is None:
             return None
+        value_id = self._recall(column, value)
+        if value_id is not None:
+            return value_id
         dbc = self.dbh.cursor()
         dbc.execute("INSERT OR IGNORE INTO {0} ({0}) VALUES (?)"
                     .format(column), [value])
@@ -203,8 +266,38 @@ class IDMap(object):
                     .format(column), [value])
         row = dbc.fetchone()
         assert row and row[0]
+        self._remember(column, value, row[0])
         return row[0]
 
+    def lookup_many(self, column, values):
+        """Lookup the numeric values associated with several string values
+        for a particular column, returning a dictionary."""
+
+        result = {}
+        missing = []
+        for value in set(values):
+            if value is None:
+                continue
+            value_id = self._recall(column, value)
+            if value_id is not None:
+                result[value] = value_id
+            else:
+                missing.append(value)
+        if not missing:
+            return result
+        dbc = self.dbh.cursor()
+        dbc.executemany("INSERT OR IGNORE INTO {0} ({0}) VALUES (?)"
+                        .format(column), [[value] for value in missing])
+        for values in chunks(missing, MAX_QUERY_PARAMS):
+            dbc.execute("SELECT {0}, {0}_id FROM {0} WHERE {0} IN ({1})"
+                        .format(column, ','.join('?' * len(values))),
+                        values)
+            for value, value_id in dbc.fetchall():
+                result[value] = value_id
+                self._remember(column, value, value_id)
+        assert all(value in result for value in missing)
+        return result
+
 class MovieGuide(object):
     """Class encapsulating variables for the bot."""
 
@@ -216,6 +309,19 @@ class MovieGuide(object):
                       ('username', 'password',))
         s_conf = dict((i, config.get('settings', i)) for i in
                       ('imdburl','freebasekey'))
+        s_conf['cache'] = config_get(config, 'settings', 'cache', None)
+        s_conf['wikidata_index'] = config_get(config, 'settings',
+                                              'wikidata_index', None)
+        s_conf['imdb_index'] = config_get(config, 'settings', 'imdb_index',
+                                          None)
+        s_conf['wikipedia_streaming'] = \
+            config.has_option('settings', 'wikipedia_streaming') and \
+            config.getboolean('settings', 'wikipedia_streaming')
+
+        # Number of posts to look up concurrently
+        self.workers = int(config_get(config, 'settings', 'workers', 1))
+        if self.workers > 1:
+            common.configure_async(self.workers)
 
         # Database filename
         self.dbfile = config.get('settings', 'database')
@@ -228,6 +334,10 @@ class MovieGuide(object):
             self.backup_auth = ()
         self.last_full = date.today()
         self.last_incr = datetime.min
+        # Backups run in a worker thread; at most one may be waiting.
+        self.backup_queue = Queue(1)
+        self.backup_error = None
+        self.backup_thread = None
 
         # Default listing settings: sort mode (new, top, etc.) and limit
         r_conf['mode'] = config_get(config, 'reddit', 'mode', 'new')
@@ -248,6 +358,27 @@ class MovieGuide(object):
         r_conf['prefer_series'] = config_get(config, 'reddit',
                                              'prefer_series', False)
 
+        # HTTP proxy for upstream hosts (default: from the environment)
+        proxy = config_get(config, 'settings', 'proxy', None)
+        if proxy is not None:
+            httpclient.set_proxy(proxy)
+
+        # Rate limits for upstream hosts: hostname=interval[,burst]
+        if config.has_section('ratelimit'):
+            for host, value in config.items('ratelimit'):
+                try:
+                    limit = [float(i) for i in value.split(',')]
+                    if len(limit) > 2 or limit[0] < 0 or \
+                            (len(limit) > 1 and limit[1] < 1):
+                        raise ValueError
+                except ValueError:
+                    raise ValueError("[ratelimit] %s: expected "
+                                     "INTERVAL[,BURST], not %r (use host "
+                                     "names without ports)" % (host, value))
+                common.configure_ratelimit(host, limit[0],
+                                           int(limit[1]) if len(limit) > 1
+                                           else 1)
+
         # Heartbeat file
         self.heartbeatfile = config_get(config, 'settings', 'heartbeat', None)
         self.errordelay = DEFAULT_ERRORDELAY
@@ -305,7 +436,9 @@ class MovieGuide(object):
         # Database for storing history
         print "Opening %s..." % self.dbfile
         self.db = sqlite3.connect(self.dbfile)
+        schema_upgrade.upgrade(self.db)
         self.idmap = IDMap(self.db)
+        self.idmap.preload('subreddit')
 
         # Access reddit
         print "Connecting..."
@@ -316,10 +449,17 @@ class MovieGuide(object):
 
         # IMDb API
         self.author = author.Author(imdburl=s_conf['imdburl'],
-                                    freebasekey=s_conf['freebasekey'])
+                                    freebasekey=s_conf['freebasekey'],
+                                    cachefile=s_conf['cache'],
+                                    wikipedia_streaming=
+                                    s_conf['wikipedia_streaming'],
+                                    wikidata_index=s_conf['wikidata_index'],
+                                    imdb_index=s_conf['imdb_index'],
+                                    workers=self.workers)
 
     def heartbeat(self):
         """Update heartbeat file (if configured) with current timestamp."""
+        self.check_backup()
         if self.heartbeatfile:
             heartbeatfh = open(self.heartbeatfile, 'w')
             heartbeatfh.write('ALLOK %s' % (time.time(),))
@@ -340,37 +480,131 @@ class MovieGuide(object):
 
         sr = self.reddit.get_subreddit(subreddit)
 
+        # The newest post seen last time, for listings in chronological order
+        cursor = None
+        if mode == 'new':
+            dbc.execute("SELECT fullname, created_utc FROM fetch_cursor " +
+                        "WHERE subreddits=?", [subreddit])
+            cursor = dbc.fetchone()
+
         # Get new submissions
         # Get correct PRAW function: new => get_new,
         #                            top-year => get_top_from_year
         sr_get = getattr(sr, 'get_' + '_from_'.join(mode.split('-')))
-        print "Checking for %d %s posts in %s..." % (limit, mode, str(sr))
-
-        posts = sr_get(limit=limit)
-        nfound = 0
+        if cursor:
+            # Page back until we reach the last post we have seen
+            print "Checking for %s posts since %s in %s..." % \
+                (mode, cursor[0], str(sr))
+            posts = sr_get(limit=limit*CATCHUP_FACTOR,
+                           place_holder=cursor[0].split('_', 1)[-1])
+        else:
+            print "Checking for %d %s posts in %s..." % (limit, mode, str(sr))
+            posts = sr_get(limit=limit)
+        listed = []
         nskipped = 0
+        newest = None
         for post in posts:
+            if cursor and (post.fullname == cursor[0] or
+                           post.created_utc < cursor[1]):
+                # Reached the last post seen (or an older one, if that post
+                # has since been deleted)
+                break
+            if mode == 'new' and newest is None:
+                newest = post
             post.decoded_title = _htmlparser.unescape(post.title)
             # Check post against configured criteria
             if not all(x.check(post) for x in criteria):
                 nskipped += 1
                 continue
-            # FIXME: Track the most recent post that we've processed, continue
-            #        until we hit our last timestamp.
-            # if lastsuccess < post.created_utc:
-            #     lastsuccess = post.created_utc
-            dbc.execute("SELECT 1 FROM history WHERE postid=?", [post.id])
-            if not dbc.fetchone():
-                subreddit_id = self.idmap.lookup('subreddit',
-                                                 post.subreddit.display_name)
-                dbc.execute("INSERT INTO history(postid, subreddit_id, " +
-                            "posttitle, status) VALUES (?, ?, ?, ?)",
-                            [post.id, subreddit_id,
-                             post.decoded_title, STATUS_WAITING])
-                nfound += 1
+            listed.append(post)
+
+        # Find which of the listed posts are new, with one query per chunk
+        known = set()
+        for ids in chunks(set(post.id for post in listed), MAX_QUERY_PARAMS):
+            dbc.execute("SELECT postid FROM history WHERE postid IN (%s)" %
+                        (','.join('?' * len(ids)),), ids)
+            known.update(row[0] for row in dbc)
+        new_posts = []
+        for post in listed:
+            if post.id not in known:
+                known.add(post.id)
+                new_posts.append(post)
+
+        # Insert the new posts
+        subreddit_ids = self.idmap.lookup_many(
+            'subreddit', (post.subreddit.display_name for post in new_posts))
+        dbc.executemany("INSERT INTO history(postid, subreddit_id, " +
+                        "posttitle, status) VALUES (?, ?, ?, ?)",
+                        [[post.id,
+                          subreddit_ids[post.subreddit.display_name],
+                          post.decoded_title, STATUS_WAITING]
+                         for post in new_posts])
+        nfound = len(new_posts)
+        if newest is not None:
+            dbc.execute("INSERT OR REPLACE INTO fetch_cursor (subreddits, " +
+                        "fullname, created_utc) VALUES (?, ?, ?)",
+                        [subreddit, newest.fullname, newest.created_utc])
         self.db.commit()
         print "Discovered %d new posts (%d skipped)." % (nfound, nskipped)
 
+    def review_posts(self, pending, end_time=None):
+        """Parse the titles of pending posts and generate reviews, yielding
+        (row, title, year, (movie, comment_text)) for each post in order.
+        With more than one worker, the reviews for the next few posts are
+        generated in the background while earlier posts are handled, until
+        the posts already queued would take us past end_time."""
+
+        def _parse(row):
+            """Parse a title using per-subreddit settings."""
+            postid, subreddit, posttitle = row
+            settings = self.subreddits[subreddit.lower()]
+            title, year = parse_title(posttitle)
+            if settings['prefer_series'] and '"' not in title:
+                title = '"' + title + '"'
+            return title, year
+
+        def _parse_batches():
+            """Parse titles a batch at a time, warming the caches for each
+            batch with bulk requests."""
+            for batch in chunks(pending, PREFETCH_POSTS):
+                batch = [(row,) + _parse(row) for row in batch]
+                self.author.prefetch([(title, year)
+                                      for row, title, year in batch])
+                for item in batch:
+                    yield item
+
+        if self.workers <= 1:
+            for row, title, year in _parse_batches():
+                yield row, title, year, self.author.process_item(title, year)
+            return
+
+        jobs = deque()
+        try:
+            for row, title, year in _parse_batches():
+                # Don't start reviews that won't be posted before end_time
+                if end_time is not None and \
+                        time.time() + len(jobs)*POST_DELAY > end_time:
+                    break
+                jobs.append((row, title, year,
+                             self.author.process_item_async(title, year)))
+                if len(jobs) >= self.workers:
+                    row, title, year, job = jobs.popleft()
+                    yield row, title, year, job.get()
+            while jobs:
+                row, title, year, job = jobs.popleft()
+                yield row, title, year, job.get()
+        finally:
+            # Reviews still queued when the caller stops are dropped; the
+            # posts stay waiting and are reviewed again next time.
+            jobs.clear()
+
+    @staticmethod
+    def print_ratelimit_stats():
+        """Report how long we have waited on each upstream rate limit."""
+        for host, waits, wait_time in common.ratelimit_stats():
+            print "Rate limit %s: waited %d times, %.1f s" % \
+                (host, waits, wait_time)
+
     def process_posts(self):
         """
             Given a post object from praw:
@@ -381,19 +615,33 @@ class MovieGuide(object):
         """
 
         dbc = self.db.cursor()
+        # The status is not a parameter, so the partial index
+        # history_waiting can be used.
         pending = dbc.execute("SELECT postid, subreddit, posttitle " +
                               "FROM history " +
                               "LEFT JOIN subreddit USING (subreddit_id) " +
-                              "WHERE status=? ORDER BY postid DESC",
-                              [STATUS_WAITING]).fetchall()
+                              "WHERE status=%d ORDER BY postid DESC" %
+                              (STATUS_WAITING,)).fetchall()
 
         print "Processing %d posts." % len(pending)
 
         # Don't spend more than two intervals processing posts
         end_time = time.time() + 2*INTERVAL*60
 
-        for row in pending:
+        reviews = self.review_posts(pending, end_time)
+        try:
+            return self._post_reviews(dbc, reviews, end_time)
+        finally:
+            # Stop generating reviews if we return early or fail
+            reviews.close()
+
+    def _post_reviews(self, dbc, reviews, end_time):
+        """Post the reviews generated by review_posts, returning False if
+        we stopped at end_time."""
+        for row, title, year, review in reviews:
             postid, subreddit, posttitle = row
+            # Stop at once if the last backup failed
+            self.check_backup()
             # Check if item has already been processed
             print (u"Found http://redd.it/%s %s in /r/%s" %
                    (postid, posttitle, subreddit)).encode('utf-8')
@@ -401,15 +649,11 @@ class MovieGuide(object):
             # Get per-subreddit settings
             settings = self.subreddits[subreddit.lower()]
 
-            # Parse item titles
-            title, year = parse_title(posttitle)
-            if settings['prefer_series'] and '"' not in title:
-                title = '"' + title + '"'
             print (u"Parsed title: %s (%s)" % (title, str(year))) \
                 .encode('utf-8')
 
-            # Generate a review
-            movie, comment_text = self.author.process_item(title, year)
+            # Review generated by review_posts
+            movie, comment_text = review
             comment_status = STATUS_NOMATCH if comment_text is None \
                 else STATUS_EXACT
             comment_id = None
@@ -465,13 +709,15 @@ class MovieGuide(object):
             # Report heartbeat
             self.heartbeat()
 
-            time.sleep(5)
+            time.sleep(POST_DELAY)
             # If we're taking to long, pause and come back
             if time.time() > end_time:
+                self.print_ratelimit_stats()
                 return False
 
         # We have finished processing all posts, report heartbeat and
         # return true.
+        self.print_ratelimit_stats()
         self.heartbeat()
         return True
 
@@ -493,12 +739,45 @@ class MovieGuide(object):
                 if full:
                     self.last_full = now_date
 
+    def backup_worker(self):
+        """Perform the backups requested by queue_backup, remembering any
+        error for check_backup to raise."""
+        while True:
+            self.backup_queue.get()
+            try:
+                self.do_backup()
+            except Exception:
+                self.backup_error = sys.exc_info()
+            self.backup_queue.task_done()
+
+    def check_backup(self):
+        """Raise the error from the last backup if it failed."""
+        if self.backup_error:
+            error, self.backup_error = self.backup_error, None
+            raise error[0], error[1], error[2]
+
+    def queue_backup(self):
+        """Ask the worker thread to upload a database backup. If a backup
+        is already waiting, wait for the worker to start it. Raises the
+        error from the last backup if it failed."""
+        if not self.backup_url:
+            # Nothing reads the changelog: keep it from growing
+            backup.discard_changelog(self.dbfile)
+            return
+        self.check_backup()
+        if not self.backup_thread:
+            self.backup_thread = threading.Thread(target=self.backup_worker,
+                                                  name='backup')
+            self.backup_thread.daemon = True
+            self.backup_thread.start()
+        self.backup_queue.put(True)
+
     def do_one_loop(self):
         """Download new posts, post comments for a while, and send a backup."""
-        # Perform backup
-        self.do_backup()
-        # No try...except! If backup fails, we want to be noticed and
-        # fixed (We don't want to generate more data!)
+        # Perform backup (in the background)
+        self.queue_backup()
+        # No try...except! If the last backup failed, we want to be
+        # noticed and fixed (We don't want to generate more data!)
 
         # Download new posts from reddit
         for subreddit, options in self.fetch:
@@ -1,23 +1,103 @@
 #!/usr/bin/env python
 import sqlite3
 import sys
-import os.path
-from movieguide import IDMap
+
+def changelog_triggers(table, key, columns):
+    """Generate triggers recording each change to a table as an SQL
+    statement in the changelog, which backup.py replays."""
+    values = " || ', ' || ".join('quote(NEW.%s)' % (col,) for col in columns)
+    insert = ("'INSERT OR REPLACE INTO %s (%s) VALUES (' || %s || ')'" %
+              (table, ', '.join(columns), values))
+    delete = "'DELETE FROM %s WHERE %s=' || quote(OLD.%s)" % (table, key, key)
+    return (
+        "CREATE TRIGGER IF NOT EXISTS %s_log_insert AFTER INSERT ON %s "
+        "BEGIN INSERT INTO changelog (statement) VALUES (%s); END" %
+        (table, table, insert),
+        "CREATE TRIGGER IF NOT EXISTS %s_log_update AFTER UPDATE ON %s "
+        "BEGIN INSERT INTO changelog (statement) SELECT %s "
+        "WHERE OLD.%s IS NOT NEW.%s; "
+        "INSERT INTO changelog (statement) VALUES (%s); END" %
+        (table, table, delete, key, key, insert),
+        "CREATE TRIGGER IF NOT EXISTS %s_log_delete AFTER DELETE ON %s "
+        "BEGIN INSERT INTO changelog (statement) VALUES (%s); END" %
+        (table, table, delete),
+    )
+
+# Each migration is a list of statements bringing the database from
+# version i to version i+1; the version is kept in PRAGMA user_version.
+# Statements must be idempotent, since databases created before
+# versioning start at version 0 whatever tables they already have.
+MIGRATIONS = (
+    # 1: Initial schema
+    ("CREATE TABLE IF NOT EXISTS history (postid TEXT NOT NULL PRIMARY KEY, "
+     "status INTEGER, subreddit_id INTEGER, posttitle TEXT, "
+     "commentid TEXT, title_id INTEGER)",
+     "CREATE TABLE IF NOT EXISTS subreddit (subreddit_id INTEGER NOT NULL "
+     "PRIMARY KEY, subreddit TEXT NOT NULL UNIQUE)",
+     "CREATE TABLE IF NOT EXISTS title (title_id INTEGER NOT NULL "
+     "PRIMARY KEY, title TEXT NOT NULL UNIQUE)"),
+    # 2: Newest post seen in each subreddit
+    ("CREATE TABLE IF NOT EXISTS fetch_cursor (subreddits TEXT NOT NULL "
+     "PRIMARY KEY, fullname TEXT NOT NULL, created_utc REAL NOT NULL)",),
+    # 3: Covering index of posts waiting to be processed (status 0 is
+    # movieguide.STATUS_WAITING), for MovieGuide.process_posts
+    ("CREATE INDEX IF NOT EXISTS history_waiting ON history "
+     "(postid, subreddit_id, posttitle, status) WHERE status=0",),
+    # 4: Log of changes, for incremental backups
+    ("CREATE TABLE IF NOT EXISTS changelog (seq INTEGER NOT NULL PRIMARY KEY "
+     "AUTOINCREMENT, statement TEXT NOT NULL)",) +
+    changelog_triggers('history', 'postid',
+                       ('postid', 'status', 'subreddit_id', 'posttitle',
+                        'commentid', 'title_id')) +
+    changelog_triggers('subreddit', 'subreddit_id',
+                       ('subreddit_id', 'subreddit')) +
+    changelog_triggers('title', 'title_id', ('title_id', 'title')) +
+    changelog_triggers('fetch_cursor', 'subreddits',
+                       ('subreddits', 'fullname', 'created_utc')),
+)
+SCHEMA_VERSION = len(MIGRATIONS)
+
+def upgrade(dbh):
+    """Apply any migrations the database has not seen yet. Each migration
+    runs in its own transaction, so this is safe to run at every
+    startup."""
+    version = dbh.execute("PRAGMA user_version").fetchone()[0]
+    if version > SCHEMA_VERSION:
+        raise RuntimeError("Database schema version %d is newer than %d" %
+                           (version, SCHEMA_VERSION))
+    isolation_level = dbh.isolation_level
+    dbh.isolation_level = None  # Manage transactions here
+    try:
+        for i in range(version, SCHEMA_VERSION):
+            print "Upgrading database schema to version %d..." % (i+1)
+            dbh.execute("BEGIN")
+            try:
+                for statement in MIGRATIONS[i]:
+                    dbh.execute(statement)
+                dbh.execute("PRAGMA user_version = %d" % (i+1))
+            except:
+                dbh.execute("ROLLBACK")
+                raise
+            dbh.execute("COMMIT")
+    finally:
+        dbh.isolation_level = isolation_level
 
 def convert(odb, ndb):          # old_db, new_db
+    from movieguide import IDMap
+    upgrade(ndb)
     idmap = IDMap(ndb)          # movieguide.
     ocur = odb.cursor()
     ocur.execute('select * from history')
     rows = ocur.fetchall()
     ncur = ndb.cursor()
-    with open(os.path.join(os.path.dirname(__file__), 'schema.txt')) as f:
-        for l in f:
-            ncur.execute(l)
+    rows = [dict(zip([x[0] for x in ocur.description], row)) for row in rows]
+    subreddit_ids = idmap.lookup_many('subreddit',
+                                      (row['subreddit'] for row in rows))
+    title_ids = idmap.lookup_many('title', (row['title'] for row in rows))
     for i, row in enumerate(rows):
-        row = dict(zip([x[0] for x in ocur.description], row))
         sys.stdout.write("\r%3d%% %-10s" % (i*100/len(rows), row['postid']))
-        subreddit_id = idmap.lookup('subreddit', row['subreddit'])
-        title_id = idmap.lookup('title', row['title'])
+        subreddit_id = subreddit_ids.get(row['subreddit'])
+        title_id = title_ids.get(row['title'])
         assert (subreddit_id is None) == (row['subreddit'] is None)
         assert (title_id is None) == (row['title'] is None)
         ncur.execute("INSERT INTO history (postid, status, subreddit_id, " +
@@ -29,9 +109,13 @@ def convert(odb, ndb):          # old_db, new_db
     sys.stdout.write("\n");
 
 def _main(argv):
+    if len(argv) == 1:
+        upgrade(sqlite3.connect(argv[0]))
+        return
     if len(argv) != 2:
-        sys.stderr.write('Usage: %s <old_db> <new_db>\n')
+        sys.stderr.write('Usage: %s <db> | <old_db> <new_db>\n' %
+                         (sys.argv[0],))
         sys.exit(1)
-    convert(sqlite3.connect(sys.argv[1]), sqlite3.connect(sys.argv[2]))
+    convert(sqlite3.connect(argv[0]), sqlite3.connect(argv[1]))
 if __name__ == '__main__':
     _main(sys.argv[1:])
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Tests for imdblocal, on small datasets written to a temporary directory.
+
+Usage: python -m unittest test_imdblocal
+"""
+
+from gzip import GzipFile
+import os
+import shutil
+import tempfile
+import unittest
+
+import imdblocal
+
+HEADERS = {
+    'title.basics': ('tconst', 'titleType', 'primaryTitle', 'originalTitle',
+                     'isAdult', 'startYear', 'endYear', 'runtimeMinutes',
+                     'genres'),
+    'title.ratings': ('tconst', 'averageRating', 'numVotes'),
+    'title.crew': ('tconst', 'directors', 'writers'),
+    'title.principals': ('tconst', 'ordering', 'nconst', 'category', 'job',
+                         'characters'),
+    'name.basics': ('nconst', 'primaryName', 'birthYear', 'deathYear',
+                    'primaryProfession', 'knownForTitles'),
+}
+
+def write_datasets(directory, titles):
+    """Write datasets for a list of (tconst, type, title, year, votes)."""
+    rows = dict((name, []) for name in HEADERS)
+    for tconst, ttype, title, year, votes in titles:
+        rows['title.basics'].append((tconst, ttype, title, title, '0',
+                                     str(year), '\\N', '90', 'Animation'))
+        rows['title.ratings'].append((tconst, '8.3', str(votes)))
+        rows['title.crew'].append((tconst, 'nm0000001', '\\N'))
+    rows['title.principals'].append(('tt9000001', '1', 'nm0000002', 'actor',
+                                     '\\N', '["Carl"]'))
+    rows['name.basics'].extend([('nm0000001', 'Pete Docter', '\\N', '\\N',
+                                 '', ''),
+                                ('nm0000002', 'Ed Asner', '\\N', '\\N',
+                                 '', '')])
+    for name, header in HEADERS.items():
+        outfh = GzipFile(os.path.join(directory, name + '.tsv.gz'), 'wb')
+        for row in [header] + rows[name]:
+            outfh.write(u'\t'.join(row).encode('utf-8') + '\n')
+        outfh.close()
+
+class IMDbLocalTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        words = ('set', 'town', 'stream', 'close', 'north')
+        # Many more decoys than MAX_CANDIDATES, sharing every trigram of
+        # the query with the title being searched for
+        decoys = [('tt1%06d' % (i,), 'movie',
+                   'Up %s %d' % (words[i % len(words)], i), 2009, 10)
+                  for i in range(2000)]
+        titles = [('tt9000001', 'movie', 'Up', 2009, 1000000),
+                  ('tt0000002', 'tvSeries', u'Ōkami', 2000, 100)]
+        write_datasets(cls.directory, titles + decoys)
+        cls.indexfile = os.path.join(cls.directory, 'index.db')
+        imdblocal.build_index(cls.directory, cls.indexfile)
+        cls.index = imdblocal.IMDbLocal(cls.indexfile)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.index.dbh.close()
+        shutil.rmtree(cls.directory)
+
+    def test_exact_match_among_decoys(self):
+        for year in (2009, None):
+            movie = self.index.search(u'Up', year)
+            self.assertEqual(movie['title'], u'Up (2009)')
+            self.assertEqual(movie['imdbid'], 'tt9000001')
+            self.assertEqual(movie['_score'], 1.0)
+
+    def test_record(self):
+        movie = self.index.search(u'up', 2009)
+        self.assertEqual(movie['rating'], [None, 1000000, u'8.3'])
+        self.assertEqual(movie['cast'], [[u'Ed Asner', u'Carl']])
+        self.assertEqual(movie['directors'], [[u'Pete Docter']])
+        self.assertEqual(movie['running_time'], 90)
+        self.assertEqual(movie['plot'], None)
+
+    def test_series_without_accents(self):
+        movie = self.index.search(u'"Okami"', 2000)
+        self.assertEqual(movie['title'], u'"Ōkami" (2000)')
+
+    def test_no_match(self):
+        self.assertRaises(imdblocal.jsonapi.IMDbError, self.index.search,
+                          u'Zzyzx', None)
+
+if __name__ == '__main__':
+    unittest.main()
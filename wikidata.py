@@ -4,64 +4,219 @@ Python interface to Wikidata
 """
 
 import json
-import urllib2
 import urllib
+import re
 
-import common, wikipedia
+import common, httpclient, wikipedia
 
 USER_AGENT = 'MovieGuide-wikidata/0.1'
 
+# Timeouts for connecting to Wikidata and reading from it, in seconds.
+# (The query service gives up on queries after a minute.)
+TIMEOUT = (10, 90)
+
+# Lifetime of cached entities and query results, in seconds. Expired
+# entities are revalidated against their latest revision ID.
+CACHE_TTL = 24*60*60
+CACHE_QUERY_TTL = 7*24*60*60
+CACHE_NEGATIVE_TTL = 24*60*60
+
+# Properties and sitelinks used by WikidataItem, which are requested from
+# Wikidata and kept in the cache.
+CLAIM_PROPS = ('P646', 'P1258', 'P1712', 'P1874')
+SITELINK_WIKIS = ('enwiki',)
+
+# Maximum number of entities requested from wbgetentities at once (the
+# API's limit), and of IMDb IDs looked up in one SPARQL query.
+ENTITY_BATCH = 50
+QUERY_BATCH = 200
+
+IMDBID_RE = re.compile(r'^[a-z]{2}[0-9]+$')
+
+def chunks(seq, size):
+    """Split a sequence into lists of at most size items."""
+    seq = list(seq)
+    return [seq[i:i+size] for i in xrange(0, len(seq), size)]
+
+def _get(url):
+    """Request a URL from Wikidata and parse the JSON response."""
+    return json.loads(httpclient.get(url, {'User-Agent': USER_AGENT},
+                                     timeout=TIMEOUT))
+
+def project_entity(entity):
+    """Reduce an entity from wbgetentities to the few claims and the
+    sitelinks used by WikidataItem."""
+    claims = {}
+    for prop in CLAIM_PROPS:
+        if prop not in entity.get('claims', {}):
+            continue
+        values = []
+        for v in entity['claims'][prop]:
+            snak = v['mainsnak']
+            if snak['snaktype'] != 'value':
+                continue        # No value, or unknown value
+            if snak['datatype'] in ('string', 'external-id'):
+                assert snak['datavalue']['type'] == 'string'
+                values.append(snak['datavalue']['value'])
+            else:
+                raise NotImplementedError
+            # FIXME: handle rank, etc.
+        claims[prop] = values
+    sitelinks = dict((wiki, link['title']) for wiki, link
+                     in entity.get('sitelinks', {}).iteritems()
+                     if wiki in SITELINK_WIKIS)
+    return {'id': entity['id'], 'lastrevid': entity['lastrevid'],
+            'claims': claims, 'sitelinks': sitelinks}
+
 class WikidataItem(object):
-    """Interface to a Wikidata item"""
+    """Interface to a Wikidata item. The item is loaded from a local index
+    (see wikidata_dump), Wikidata or the cache by load, or when it is first
+    used."""
+
+    __slots__ = ('key', 'cache', 'index', 'lastrevid', 'claims', 'sitelinks',
+                 'awards')
 
-    ratelimit = common.RateLimit(5)
+    # Allow the revision check and the download back-to-back
+    ratelimit = common.host_ratelimit('www.wikidata.org', 5, burst=2)
 
-    def __init__(self, itemid):
+    def __init__(self, itemid, cache=None, index=None):
         self.key = 'Q%d' % (itemid,)
+        self.cache = cache
+        self.index = index
+        self.lastrevid = None   # Not loaded yet
+        self.claims = None
+        self.sitelinks = None
+        self.awards = None
+
+    def load(self):
+        """Load the item, if it has not been loaded yet. Returns the item."""
+        if self.claims is not None or self._load_index():
+            return self
+        cache = self.cache
+        entry = cache.lookup(self.key) if cache else None
+
+        if entry and entry[2]:
+            # Entry has expired; check if the entity has been edited since
+            if self._lastrevid() == entry[1]:
+                cache.touch(self.key, CACHE_TTL)
+            else:
+                entry = None
+        if entry:
+            self._set(entry[0])
+        else:
+            self._set(self._download(), store=True)
+        return self
+
+    def _set(self, obj, store=False):
+        """Fill in the item from a projection (and maybe cache it)."""
+        if store and self.cache and obj['lastrevid'] is None:
+            self.cache.put(self.key, obj, CACHE_NEGATIVE_TTL)
+        elif store and self.cache:
+            self.cache.put(self.key, obj, CACHE_TTL,
+                           revision=str(obj['lastrevid']))
+        self.key = obj['id'] # Handle redirects
+        self.lastrevid = obj['lastrevid']
+        self.sitelinks = obj['sitelinks']
+        self.claims = obj['claims']
+        self.awards = obj.get('awards', None)
+
+    def _load_index(self):
+        """Load the item from the local index, if it is there. Returns True
+        if it was."""
+        obj = self.index.entity(int(self.key[1:])) if self.index else None
+        if obj:
+            self._set(obj)
+        return bool(obj)
+
+    @classmethod
+    def load_many(cls, items):
+        """Load several items, downloading those which are not in the cache
+        (or have expired) up to ENTITY_BATCH at a time."""
+        pending = []
+        for item in items:
+            if item.claims is not None or item._load_index():
+                continue
+            entry = item.cache.lookup(item.key) if item.cache else None
+            if entry and not entry[2]:
+                item._set(entry[0])
+            else:
+                pending.append(item)
+        for batch in chunks(pending, ENTITY_BATCH):
+            entities = cls._download_entities(
+                sorted(set(item.key for item in batch)))
+            for item in batch:
+                item._set(entities[item.key], store=True)
+        return items
+
+    def load_async(self):
+        """Start loading the item on the shared lookup pool, returning an
+        AsyncResult for the item."""
+        return common.run_async(self.load)
+
+    def _download(self):
+        """Download the claims and sitelinks used from the entity and return
+        its projection."""
+        return self._download_entities([self.key])[self.key]
+
+    @classmethod
+    def _download_entities(cls, keys):
+        """Download the claims and sitelinks used from several entities,
+        returning a dict of their projections by (requested) ID."""
+
+        cls.ratelimit.wait()
+
+        # Request items
+        obj = _get('https://www.wikidata.org/w/api.php?%s' %
+                   (urllib.urlencode({'action': 'wbgetentities',
+                                      'ids': '|'.join(keys),
+                                      'props': 'info|claims|sitelinks',
+                                      'sitefilter': '|'.join(SITELINK_WIKIS),
+                                      'format': 'json'}),))
+
+        # Extract objects from response, which may be listed under the
+        # ID they were redirected to
+        result = {}
+        for key, entity in obj['entities'].iteritems():
+            if 'missing' in entity:
+                # Deleted (or never existed): an item with no claims
+                result[key] = {'id': key, 'lastrevid': None, 'claims': {},
+                               'sitelinks': {}}
+                continue
+            projection = project_entity(entity)
+            result[key] = projection
+            if 'redirects' in entity:
+                result[entity['redirects']['from']] = projection
+        assert all(key in result for key in keys)
+        return result
+
+    def _lastrevid(self):
+        """Look up the latest revision ID of the entity, without downloading
+        the entity itself."""
 
         self.ratelimit.wait()
 
-        # Request item
-        url = 'https://www.wikidata.org/entity/%s.json' % (self.key,)
-        headers = {'User-Agent': USER_AGENT}
-        req = urllib2.Request(url, None, headers)
-        response = urllib2.urlopen(req, timeout=8*60)
-        data = response.read()
-
-        # Extract object from response
-        self.obj = json.loads(data)
-        assert self.obj['entities'] and len(self.obj['entities']) == 1
-        self.key = self.obj['entities'].iterkeys().next() # Handle redirects
-        self.obj = self.obj['entities'][self.key]
+        obj = _get('https://www.wikidata.org/w/api.php?%s' %
+                   (urllib.urlencode({'action': 'wbgetentities',
+                                      'ids': self.key, 'props': 'info',
+                                      'format': 'json'}),))
+        assert obj['entities'] and len(obj['entities']) == 1
+        entity = obj['entities'].itervalues().next()
+        return str(entity['lastrevid']) if 'lastrevid' in entity else None
 
     def get_claim(self, prop):
-        claims = self.obj['claims']
-        if prop not in claims:
-            return None
-        values = []
-        for v in claims[prop]:
-            snak = v['mainsnak']
-            if snak['datatype'] in ('string', 'external-id'):
-                assert snak['datavalue']['type'] == 'string'
-                values.append(snak['datavalue']['value'])
-            else:
-                raise NotImplementedError
-            # FIXME: handle rank, etc.
-        return values
+        assert prop in CLAIM_PROPS
+        return self.load().claims.get(prop, None)
 
     def get_sitelink(self, wiki):
-        sitelinks = self.obj.get('sitelinks', {})
-        if wiki not in sitelinks:
-            return None
-        assert 'title' in sitelinks[wiki]
-        return sitelinks[wiki]['title']
+        assert wiki in SITELINK_WIKIS
+        return self.load().sitelinks.get(wiki, None)
 
     def wikipedia_url(self, lang='en'):
         enwiki = self.get_sitelink(lang + 'wiki')
         return wikipedia.url_from_title(enwiki) if enwiki else None
 
     def wikidata_url(self):
-        return "https://www.wikidata.org/wiki/%s" % (self.key,)
+        return "https://www.wikidata.org/wiki/%s" % (self.load().key,)
 
     # FIXME: Format these automatically using P1630.
 
@@ -71,7 +226,7 @@ class WikidataItem(object):
         return None
 
     def rotten_tomatoes_url(self):
-        value = self.get_claim('P646') # Rotten Tomatoes identifier
+        value = self.get_claim('P1258') # Rotten Tomatoes ID
         return "http://www.rottentomatoes.com/%s" % (value[0],) \
             if value else None
 
@@ -84,11 +239,13 @@ class WikidataItem(object):
         return "http://movies.netflix.com/WiMovie/%s" % (value[0],) \
             if value else None
 
+    # Awards are only known for items in a local index.
+
     def award_nominations(self):
-        return []
+        return (self.load().awards or {}).get('nominated', [])
 
     def awards_won(self):
-        return []
+        return (self.load().awards or {}).get('won', [])
 
     def __repr__(self):
         return """<%s instance:
@@ -109,10 +266,16 @@ class WikidataItem(object):
 class WikidataQuery(object):
     """Interface to the (experimental) WikidataQuery API"""
 
-    ratelimit = common.RateLimit(5)
+    ratelimit = common.host_ratelimit('query.wikidata.org', 5)
+
+    def __init__(self, cache=None, index=None):
+        self.cache = cache
+        self.index = index
 
-    def __init__(self):
-        pass
+    def _item(self, items):
+        """Return the (unloaded) item to use from a list of item IDs."""
+        return WikidataItem(min(items), cache=self.cache, index=self.index) \
+            if items else None
 
     def _by_imdbid_wql(self, imdbid):
         """Query Wikidata via WikidataQuery API and return results."""
@@ -123,10 +286,7 @@ class WikidataQuery(object):
               (urllib.urlencode({'q': query}),)
 
         # Request results
-        req = urllib2.Request(url, None, {'User-Agent': USER_AGENT})
-        response = urllib2.urlopen(req, timeout=8*60)
-        obj = json.load(response)
-        response.close()
+        obj = _get(url)
 
         # Return response
         assert obj['status']['error'] == 'OK' and 'items' in obj
@@ -144,10 +304,7 @@ class WikidataQuery(object):
               (urllib.urlencode({'query': query, 'format': 'json'}),)
 
         # Request results
-        req = urllib2.Request(url, None, {'User-Agent': USER_AGENT})
-        response = urllib2.urlopen(req, timeout=8*60)
-        obj = json.load(response)
-        response.close()
+        obj = _get(url)
 
         # Return response
         assert 'results' in obj and 'bindings' in obj['results']
@@ -164,16 +321,88 @@ class WikidataQuery(object):
             return int(itemurl[len(prefix):], 10)
         return [_itemid(x) for x in obj['results']['bindings']]
 
-    def by_imdbid(self, imdbid):
-        """Query Wikidata and return a result."""
+    def _by_imdbids_sparql(self, imdbids):
+        """Query Wikidata via SPARQL API for several IMDb IDs at once, and
+        return a dict of the item IDs for each."""
 
         self.ratelimit.wait()
-        items = self._by_imdbid_sparql(imdbid)
 
-        if items:
-            return WikidataItem(min(items))
-        else:
-            return None
+        # Build URL
+        for imdbid in imdbids:
+            assert IMDBID_RE.match(imdbid), imdbid
+        query = 'SELECT ?item ?imdbid WHERE { VALUES ?imdbid { %s } ' \
+            '?item wdt:P345 ?imdbid . }' % \
+            (' '.join('"%s"' % (imdbid,) for imdbid in imdbids),)
+        url = 'https://query.wikidata.org/sparql?%s' % \
+              (urllib.urlencode({'query': query, 'format': 'json'}),)
+
+        # Request results
+        obj = _get(url)
+
+        # Return response
+        assert 'results' in obj and 'bindings' in obj['results']
+        assert 'head' in obj and 'vars' in obj['head'] and \
+            'item' in obj['head']['vars']
+        result = dict((imdbid, []) for imdbid in imdbids)
+        prefix = 'http://www.wikidata.org/entity/Q'
+        for binding in obj['results']['bindings']:
+            itemurl = binding['item']['value']
+            assert binding['item']['type'] == 'uri' and \
+                itemurl.startswith(prefix)
+            result[binding['imdbid']['value']].append(
+                int(itemurl[len(prefix):], 10))
+        return result
+
+    def by_imdbids(self, imdbids):
+        """Query Wikidata (or the cache) for several IMDb IDs with as few
+        requests as possible, and return a dict of the (loaded) items, or
+        None, for each."""
+
+        # Look up items for each IMDb ID
+        items = {}
+        missing = []
+        for imdbid in set(imdbids):
+            items[imdbid] = (self.index.by_imdbid(imdbid) or None) \
+                if self.index else None
+            if items[imdbid] is None and self.cache:
+                items[imdbid] = self.cache.get(imdbid)
+            if items[imdbid] is None:
+                missing.append(imdbid)
+        for batch in chunks(missing, QUERY_BATCH):
+            for imdbid, found in self._by_imdbids_sparql(batch).iteritems():
+                items[imdbid] = found
+                if self.cache:
+                    self.cache.put(imdbid, found, CACHE_QUERY_TTL if found
+                                   else CACHE_NEGATIVE_TTL)
+
+        # Load the items
+        result = dict((imdbid, self._item(found))
+                      for imdbid, found in items.iteritems())
+        WikidataItem.load_many([item for item in result.itervalues()
+                                if item])
+        return result
+
+    def by_imdbid_async(self, imdbid):
+        """Start a query on the shared lookup pool, returning an
+        AsyncResult for the result of by_imdbid."""
+        return common.run_async(self.by_imdbid, imdbid)
+
+    def by_imdbid(self, imdbid):
+        """Query the local index, the cache or Wikidata and return a
+        result."""
+
+        items = (self.index.by_imdbid(imdbid) or None) if self.index \
+            else None
+        if items is None and self.cache:
+            items = self.cache.get(imdbid)
+        if items is None:
+            items = self._by_imdbid_sparql(imdbid)
+            if self.cache:
+                self.cache.put(imdbid, items, CACHE_QUERY_TTL if items
+                               else CACHE_NEGATIVE_TTL)
+
+        item = self._item(items)
+        return item.load() if item else None
 
 
 
@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+"""
+Build a local index of films from a Wikidata JSON dump, and look items up
+in it instead of querying Wikidata.
+
+Usage: wikidata_dump.py latest-all.json.bz2 wikidata-films.db
+
+Dumps are at https://dumps.wikimedia.org/wikidatawiki/entities/
+"""
+
+import bz2
+import json
+import os
+import re
+import sqlite3
+import sys
+import time
+from gzip import GzipFile
+from threading import Lock
+
+import wikidata
+
+# Size of chunks read from the dump, and number of rows written at once.
+CHUNK_SIZE = 1024*1024
+BATCH_SIZE = 1000
+
+# Properties for awards received and nominations.
+AWARD_PROPS = {'P166': 'won', 'P1411': 'nominated'}
+# Qualifiers giving the year of an award: point in time, or start time.
+YEAR_QUALIFIERS = ('P585', 'P580')
+
+# Memory-mapped size of the index when it is read.
+MMAP_SIZE = 256*1024*1024
+
+SCHEMA = (
+    "CREATE TABLE imdb (imdbid TEXT NOT NULL, qid INTEGER NOT NULL, "
+    "PRIMARY KEY (imdbid, qid)) WITHOUT ROWID",
+    "CREATE TABLE item (qid INTEGER NOT NULL PRIMARY KEY, "
+    "entity TEXT NOT NULL)",
+    "CREATE TABLE award (qid INTEGER NOT NULL, prop TEXT NOT NULL, "
+    "award INTEGER NOT NULL, year TEXT)",
+    "CREATE TABLE label (qid INTEGER NOT NULL PRIMARY KEY, "
+    "label TEXT NOT NULL)",
+    "CREATE TABLE info (key TEXT NOT NULL PRIMARY KEY, value TEXT)",
+)
+INDEXES = (
+    "CREATE INDEX award_qid ON award (qid)",
+)
+
+ID_RE = re.compile(r'"id":"Q([0-9]+)"')
+
+def _bz2_chunks(infh):
+    """Decompress a bzip2 file, which may have several streams (as made by
+    pbzip2 or lbzip2), a chunk at a time."""
+    decompressor = bz2.BZ2Decompressor()
+    for data in iter(lambda: infh.read(CHUNK_SIZE), ''):
+        while data:
+            try:
+                chunk = decompressor.decompress(data)
+            except EOFError:
+                # The previous stream ended at the end of a chunk
+                decompressor = bz2.BZ2Decompressor()
+                continue
+            yield chunk
+            data = decompressor.unused_data
+            if data:
+                decompressor = bz2.BZ2Decompressor()
+
+def read_dump(filename):
+    """Read the entities from a JSON dump (compressed with bzip2 or gzip, or
+    not), yielding the line of JSON for each."""
+    infh = open(filename, 'rb')
+    try:
+        if filename.endswith('.bz2'):
+            chunks = _bz2_chunks(infh)
+        elif filename.endswith('.gz'):
+            gzfh = GzipFile(fileobj=infh)
+            chunks = iter(lambda: gzfh.read(CHUNK_SIZE), '')
+        else:
+            chunks = iter(lambda: infh.read(CHUNK_SIZE), '')
+        buf = ''
+        for chunk in chunks:
+            lines = (buf + chunk).split('\n')
+            buf = lines.pop()
+            for line in lines:
+                line = line.rstrip(',\r')
+                if line not in ('[', ']', ''):
+                    yield line
+        if buf.rstrip(',\r') not in ('[', ']', ''):
+            yield buf.rstrip(',\r')
+    finally:
+        infh.close()
+
+def _values(entity, prop):
+    """Return the statements of a property which have a value (and are not
+    deprecated)."""
+    return [claim for claim in entity.get('claims', {}).get(prop, [])
+            if claim['mainsnak']['snaktype'] == 'value' and
+            claim.get('rank') != 'deprecated']
+
+def _year(claim):
+    """Return the year of a statement's point in time (or start time)
+    qualifier, if any."""
+    for prop in YEAR_QUALIFIERS:
+        for snak in claim.get('qualifiers', {}).get(prop, []):
+            if snak['snaktype'] == 'value':
+                # Times look like +1995-03-27T00:00:00Z
+                return snak['datavalue']['value']['time'][1:].split('-')[0]
+    return None
+
+def build_index(dumpfile, indexfile):
+    """Build an index of the items with IMDb title IDs in a dump. The dump
+    is read twice: first for the films, then for the labels of their
+    awards."""
+    tempfile = indexfile + '.part'
+    if os.path.exists(tempfile):
+        os.remove(tempfile)
+    dbh = sqlite3.connect(tempfile)
+    dbh.execute("PRAGMA journal_mode=OFF")
+    dbh.execute("PRAGMA synchronous=OFF")
+    for statement in SCHEMA:
+        dbh.execute(statement)
+
+    # First pass: films
+    imdb_rows, item_rows, award_rows = [], [], []
+    def _flush():
+        """Write the rows collected so far."""
+        dbh.executemany("INSERT OR IGNORE INTO imdb VALUES (?, ?)", imdb_rows)
+        dbh.executemany("INSERT OR REPLACE INTO item VALUES (?, ?)",
+                        item_rows)
+        dbh.executemany("INSERT INTO award VALUES (?, ?, ?, ?)", award_rows)
+        dbh.commit()
+        del imdb_rows[:], item_rows[:], award_rows[:]
+    count = 0
+    for line in read_dump(dumpfile):
+        if '"P345"' not in line:
+            continue            # Quickly skip items without IMDb IDs
+        entity = json.loads(line)
+        if entity.get('type') != 'item':
+            continue
+        imdbids = [claim['mainsnak']['datavalue']['value'] for claim
+                   in _values(entity, 'P345')]
+        imdbids = [imdbid for imdbid in imdbids if imdbid.startswith('tt')]
+        if not imdbids:
+            continue            # People, etc.
+        qid = int(entity['id'][1:])
+        imdb_rows.extend((imdbid, qid) for imdbid in imdbids)
+        item_rows.append((qid, json.dumps(wikidata.project_entity(entity))))
+        for prop in AWARD_PROPS:
+            award_rows.extend((qid, prop,
+                               claim['mainsnak']['datavalue']['value']
+                               ['numeric-id'], _year(claim))
+                              for claim in _values(entity, prop))
+        count += 1
+        if len(item_rows) >= BATCH_SIZE:
+            _flush()
+            sys.stdout.write("\r%d films" % (count,))
+            sys.stdout.flush()
+    _flush()
+    sys.stdout.write("\r%d films\n" % (count,))
+
+    # Second pass: labels of awards
+    awards = set(row[0] for row in
+                 dbh.execute("SELECT DISTINCT award FROM award"))
+    label_rows = []
+    for line in read_dump(dumpfile):
+        match = ID_RE.search(line, 0, 200)
+        if not match or int(match.group(1)) not in awards:
+            continue
+        entity = json.loads(line)
+        label = entity.get('labels', {}).get('en')
+        if label:
+            label_rows.append((int(match.group(1)), label['value']))
+        if len(label_rows) >= BATCH_SIZE:
+            dbh.executemany("INSERT OR REPLACE INTO label VALUES (?, ?)",
+                            label_rows)
+            del label_rows[:]
+    dbh.executemany("INSERT OR REPLACE INTO label VALUES (?, ?)", label_rows)
+    print "%d awards" % (len(awards),)
+
+    for statement in INDEXES:
+        dbh.execute(statement)
+    dbh.execute("INSERT INTO info VALUES ('dump', ?)",
+                [os.path.basename(dumpfile)])
+    dbh.execute("INSERT INTO info VALUES ('built', ?)",
+                [time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())])
+    dbh.commit()
+    dbh.execute("VACUUM")
+    dbh.close()
+    os.rename(tempfile, indexfile)
+
+class WikidataIndex(object):
+    """Read-only lookups in an index built by build_index. May be shared
+    between threads."""
+
+    def __init__(self, indexfile):
+        if not os.path.exists(indexfile):
+            raise IOError("No such index: %s" % (indexfile,))
+        self.lock = Lock()
+        self.dbh = sqlite3.connect(indexfile, check_same_thread=False)
+        self.dbh.execute("PRAGMA query_only=ON")
+        self.dbh.execute("PRAGMA mmap_size=%d" % (MMAP_SIZE,))
+
+    def by_imdbid(self, imdbid):
+        """Return the item IDs with an IMDb ID."""
+        with self.lock:
+            return [row[0] for row in self.dbh.execute(
+                "SELECT qid FROM imdb WHERE imdbid=?", [imdbid])]
+
+    def entity(self, qid):
+        """Return the projection of an item (see wikidata.project_entity),
+        with its awards added, or None if it is not in the index."""
+        with self.lock:
+            row = self.dbh.execute("SELECT entity FROM item WHERE qid=?",
+                                   [qid]).fetchone()
+            if not row:
+                return None
+            awards = self.dbh.execute(
+                "SELECT prop, label, year FROM award " +
+                "LEFT JOIN label ON award.award=label.qid " +
+                "WHERE award.qid=? ORDER BY year, label", [qid]).fetchall()
+        entity = json.loads(row[0])
+        entity['awards'] = dict((kind, []) for kind in AWARD_PROPS.values())
+        for prop, label, year in awards:
+            entity['awards'][AWARD_PROPS[prop]].append({'award': label,
+                                                        'year': year})
+        return entity
+
+def _main(argv):
+    if len(argv) != 2:
+        sys.stderr.write(__doc__.strip().split('\n\n')[1] + '\n')
+        sys.exit(1)
+    build_index(argv[0], argv[1])
+
+if __name__ == '__main__':
+    _main(sys.argv[1:])
@@ -3,61 +3,123 @@ Extract information from Wikipedia articles about movies.
 """
 
 from HTMLParser import HTMLParser
-import urllib2
 import urllib
+import urlparse
+import json
 import re
+import codecs
+import itertools
 
-import common
+import common, httpclient
 
 USER_AGENT = 'MovieGuide-wikipedia/0.1'
 
-SKIPTAGS = ('table', 'sup')
-NESTTAGS = ('div', 'span', 'a')
-HEADTAGS = tuple('h'+str(i) for i in range(6))
+# Timeouts for connecting to Wikipedia and reading from it, in seconds.
+TIMEOUT = (10, 60)
+
+# Lifetime of cached articles, in seconds. Expired articles are
+# revalidated against their latest revision ID.
+CACHE_TTL = 24*60*60
+
+# Size of chunks of an article read at once when streaming.
+CHUNK_SIZE = 16*1024
+
+SKIPTAGS = frozenset(('table', 'sup'))
+NESTTAGS = frozenset(('div', 'span', 'a'))
+HEADTAGS = frozenset('h'+str(i) for i in range(6))
 SKIPSECTS = ("contents", "references", "see also", "external links", "notes")
 
 SPACING_RE = re.compile(r'\s+', flags=re.UNICODE)
+# Contents of a JSON string, up to its closing quote or an incomplete
+# escape sequence, and the first half of a surrogate pair at its end
+JSON_STRING_RE = re.compile(r'(?:[^"\\]+|\\(?:u[0-9a-fA-F]{4}|[^u]))*')
+HIGH_SURROGATE_RE = re.compile(r'\\u[dD][89abAB][0-9a-fA-F]{2}$')
+# Classes and styles of nested tags whose contents are skipped
+SKIPCLASS_RE = re.compile(r'thumbcaption|quotebox|autonumber|hatnote')
+SKIPSTYLE_RE = re.compile(r'display: ?none')
+
+class Section(object):
+    """A section of an article: its heading (None for the lead section),
+    level (0 for the lead section) and non-empty paragraphs."""
+    def __init__(self, heading, level, paragraphs):
+        self.heading = heading
+        self.level = level
+        self.paragraphs = paragraphs
+
+    def __repr__(self):
+        return 'Section(%r, %r, %r)' % (self.heading, self.level,
+                                        self.paragraphs)
 
 class WikipediaTextifier(HTMLParser):
     """
     Generate a plain text version of a Wikipedia article from a page like
     http://en.wikipedia.org/w/index.php?title=...&action=render
+
+    As well as the text (buffer), the article is split into a list of
+    Sections (sections), starting with the lead section.
     """
     def __init__(self):
         HTMLParser.__init__(self)
-        self.buffer = ''
+        self._buffer = []
+        # Sections ended so far, and the start of the current one
+        self._sections = []
+        self._section = (None, 0, 0)    # heading, level, start in _buffer
         self.skip = 0
         self.skipsect = 0       # 10 = Skip introduction
         # Buffer for storing headings
         self.inheading = 0
         self.headingbuf = ""
+        self.lastheading = None
         # List of external links
         self.links = []
 
+    @property
+    def buffer(self):
+        """The text of the article so far."""
+        return ''.join(self._buffer)
+
+    @property
+    def sections(self):
+        """The sections of the article so far."""
+        return self._sections + [self._make_section()]
+
+    @property
+    def ended_sections(self):
+        """The sections of the article which have ended so far, since a
+        later heading has been seen."""
+        return list(self._sections)
+
+    def _make_section(self):
+        """Make a Section from the text added since the current heading."""
+        heading, level, start = self._section
+        paragraphs = [para for para in
+                      (line.strip() for line in
+                       ''.join(self._buffer[start:]).split('\n'))
+                      if para]
+        return Section(heading, level, paragraphs)
+
     def _append(self, data):
         """Add data to the internal buffer"""
         if not self.skip and not self.skipsect:
-            self.buffer += data
+            self._buffer.append(data)
 
     def handle_starttag(self, tag, attrs):
-        tag = tag.lower()
-        adict = dict(attrs)
         # Save external links
-        if tag == 'a' and 'external' in adict.get('class', '') and \
-                'href' in adict:
-            self.links.append(adict['href'])
+        if tag == 'a' and attrs:
+            adict = dict(attrs)
+            if 'external' in adict.get('class', '') and 'href' in adict:
+                self.links.append(adict['href'])
 
         # Track sections of the page to skip parsing
         if (self.skip and tag in NESTTAGS) or tag in SKIPTAGS:
             self.skip += 1
         elif tag in NESTTAGS:
-            aclass = adict.get('class', '')
-            astyle = adict.get('style', '')
-            if 'thumbcaption' in aclass or 'quotebox' in aclass or \
-                    'autonumber' in aclass or 'hatnote' in aclass or \
-                    'display:none' in astyle or 'display: none' in astyle:
-                self.skip += 1
-        elif tag in ('p', 'br'):
+            if attrs:
+                adict = dict(attrs)
+                if SKIPCLASS_RE.search(adict.get('class', '')) or \
+                        SKIPSTYLE_RE.search(adict.get('style', '')):
+                    self.skip += 1
+        elif tag == 'p' or tag == 'br':
             self._append("\n")
 
         # Special handling for settings
@@ -69,41 +131,43 @@ class WikipediaTextifier(HTMLParser):
             self.headingbuf = ""
 
     def handle_endtag(self, tag):
-        tag = tag.lower()
         if (self.skip and tag in NESTTAGS) or tag in SKIPTAGS:
             self.skip -= 1
         elif tag in HEADTAGS:
             if self.inheading:
                 self.headingbuf = self.headingbuf.replace('[edit]', '').strip()
-                if self.headingbuf.lower() in SKIPSECTS:
+                self.lastheading = self.headingbuf.lower()
+                if self.lastheading in SKIPSECTS:
                     self.skipsect = self.inheading
-                self._append("\n\n%s %s\n\n" % ("#"*self.inheading,
-                                                self.headingbuf))
+                if not self.skip and not self.skipsect:
+                    # Start a new section
+                    self._sections.append(self._make_section())
+                    self._buffer.append("\n\n%s %s\n\n" %
+                                        ("#"*self.inheading, self.headingbuf))
+                    self._section = (self.headingbuf, self.inheading,
+                                     len(self._buffer))
                 self.inheading = 0
 
     def handle_data(self, data):
-        data = SPACING_RE.sub(' ', data)
         if self.inheading:
-            self.headingbuf += data
-        else:
-            self._append(data)
+            self.headingbuf += SPACING_RE.sub(' ', data)
+        elif not self.skip and not self.skipsect:
+            self._buffer.append(SPACING_RE.sub(' ', data))
 
     def handle_entityref(self, name):
-        self.handle_data(self.unescape('&%s;' % (name,)))
+        if self.inheading or not (self.skip or self.skipsect):
+            self.handle_data(self.unescape('&%s;' % (name,)))
 
     def handle_charref(self, name):
-        self.handle_data(self.unescape('&#%s;' % (name,)))
+        if self.inheading or not (self.skip or self.skipsect):
+            self.handle_data(self.unescape('&#%s;' % (name,)))
 
-# Regular expressions for the critical reception section
+# Headings of the critical reception section, in order of preference
 CRITICAL_RES = (
-    re.compile(r'#+ (Critical.*)\s*\n((?:\s*[^#\s].+)+)',
-               flags=re.UNICODE|re.I),
-    re.compile(r'#+ (Reception.*)\s*\n((?:\s*[^#\s].+)+)',
-               flags=re.UNICODE|re.I),
-    re.compile(r'#+ (Reviews|Critics)\s*\n((?:\s*[^#\s].+)+)',
-               flags=re.UNICODE|re.I),
+    re.compile(r'Critical', flags=re.UNICODE|re.I),
+    re.compile(r'Reception', flags=re.UNICODE|re.I),
+    re.compile(r'(?:Reviews|Critics)$', flags=re.UNICODE|re.I),
 )
-PARA_RE = re.compile(r'\s*\n\s*', flags=re.UNICODE)
 CRITICAL_KEYWORDS = (
     # Newspapers and magazines
     'Times', 'Herald', 'Chronicle', 'Post', 'Tribune', 'Globe', 'Mail',
@@ -116,7 +180,6 @@ CRITICAL_KEYWORDS = (
     'eview', # Review, review, reviews, reviewed, previews, ...
     )
 
-INTRO_RE = re.compile(r'^\s*((?:\s*[^#\s].+)+)', flags=re.UNICODE|re.I)
 SUMMARY_RE = re.compile(r'the film(?:\'s )? (?!was)(?!(?:[a-z]* )+' +
                         '(?:premiere|release|box office))' +
                         r'|the stor[yi]|deals with|portray|depict|follow',
@@ -137,14 +200,92 @@ def url_from_title(title, lang='en'):
     return "http://%s.wikipedia.org/w/index.php?title=%s&action=render" % \
         (urllib.quote(lang), urllib.quote(unicode(title).encode('utf-8')))
 
+def page_params(url):
+    """Return the hostname and the title or curid parameter of a URL
+    generated by url_from_title or url_from_curid."""
+    parts = urlparse.urlsplit(url)
+    query = urlparse.parse_qs(parts.query)
+    for param in ('title', 'curid'):
+        if param in query:
+            return parts.hostname, param, query[param][0]
+    return parts.hostname, None, None
+
+def api_url(host, param, value):
+    """Return the URL of an API request rendering an article by title or
+    curid, whose response also has the revision ID."""
+    query = {'action': 'parse', 'format': 'json', 'formatversion': 2,
+             'prop': 'text|revid', 'redirects': 1,
+             {'title': 'page', 'curid': 'pageid'}[param]: value}
+    return 'https://%s/w/api.php?%s' % (host, urllib.urlencode(query))
+
+def json_string(pieces):
+    """Decode a JSON string, given as pieces of text starting after its
+    opening quote, yielding it a piece at a time."""
+    pending = u''
+    for piece in pieces:
+        pending += piece
+        match = JSON_STRING_RE.match(pending)
+        body, end = match.group(), match.end()
+        done = end < len(pending) and pending[end] == u'"'
+        if not done:
+            surrogate = HIGH_SURROGATE_RE.search(body)
+            if surrogate:
+                body, end = body[:surrogate.start()], surrogate.start()
+        if body:
+            yield json.loads(u'"%s"' % (body,))
+        if done:
+            return
+        pending = pending[end:]
+
+def parse_response(pieces, info):
+    """Yield the article text from the response to an API request made by
+    api_url, given as pieces of text, a piece at a time. The other fields
+    before the text (such as revid) are put in info, or the error if the
+    request failed."""
+    head = u''
+    for piece in pieces:
+        head += piece
+        start = head.find(u'"text":"')
+        if start >= 0:
+            break
+    else:
+        # No text: the article does not exist
+        info.update(json.loads(head) if head else {})
+        return
+    info.update(json.loads(head[:start].rstrip(u',') + u'}}')['parse'])
+    for text in json_string(itertools.chain([head[start+8:]], pieces)):
+        yield text
+
 class Wikipedia(object):
     """Interface to Wikipedia"""
 
+    def __init__(self, cache=None, streaming=False):
+        self.cache = cache
+        self.streaming = streaming
+
     @staticmethod
     def parse(buf, url=None):
         """Parse a Wikipedia article for interesting information."""
         parser = WikipediaTextifier()
         parser.feed(buf)
+        return Wikipedia.result(parser, url)
+
+    @staticmethod
+    def enough(parser):
+        """Return True if the rest of an article being parsed is not needed:
+        the lead section and the preferred critical reception section
+        have ended, or the external links section has been reached (so
+        links after that are not seen)."""
+        if parser.lastheading == 'external links':
+            return True
+        return any(section.level and section.paragraphs and
+                   CRITICAL_RES[0].match(section.heading)
+                   for section in parser.ended_sections)
+
+    @staticmethod
+    def result(parser, url=None):
+        """Extract interesting information from a WikipediaTextifier which
+        has parsed an article."""
         result = {
             'critical': None, 'criticalsection': None,
             'summary': None,
@@ -152,44 +293,50 @@ class Wikipedia(object):
                 if url else None,
             }
 
-        # Critical response
+        sections = parser.sections
+
+        # Critical response: the first section with content under a
+        # matching heading
         for my_re in CRITICAL_RES:
-            match = my_re.search(parser.buffer)
-            if match:
-                result['criticalsection'] = match.group(1)
-                paras = PARA_RE.split(match.group(2))
-                # Return the first paragraph containing a critical keyword
-                for para in paras:
-                    for keyword in CRITICAL_KEYWORDS:
-                        if keyword in para:
-                            result['critical'] = para.strip()
-                            break
-                    else:
-                        continue
+            for section in sections:
+                if section.level and section.paragraphs and \
+                        my_re.match(section.heading):
                     break
+            else:
+                continue
+            result['criticalsection'] = section.heading
+            paras = section.paragraphs
+            # Return the first paragraph containing a critical keyword
+            for para in paras:
+                for keyword in CRITICAL_KEYWORDS:
+                    if keyword in para:
+                        result['critical'] = para
+                        break
                 else:
-                    # If no such paragraph, return the first paragraph
-                    result['critical'] = paras[0].strip()
+                    continue
                 break
+            else:
+                # If no such paragraph, return the first paragraph
+                result['critical'] = paras[0]
+            break
 
-        # Summary from introduction
-        match = INTRO_RE.search(parser.buffer)
-        if match:
-            paras = PARA_RE.split(match.group(1))
+        # Summary from introduction (the lead section)
+        paras = sections[0].paragraphs
+        if paras:
             # Return the first paragraph containing a plot summary keyword
             for para in paras:
                 if SUMMARY_RE.search(para):
-                    result['summary'] = para.strip()
+                    result['summary'] = para
                     break
             else:
                 # If no such paragraph, return the first paragraph
-                result['summary'] = paras[0].strip()
+                result['summary'] = paras[0]
 
         # Avoid accidental JavaScript
         for data in (x for x in (result['summary'], result['critical']) if x):
             for check in ('function mfTemp', 'document.getElement',
                           '.className', ';}', '){', '{var'):
-                assert check not in result['summary']
+                assert check not in data
 
         # URLs for Rotten Tomatoes, Metacritic, etc.
         for url in parser.links:
@@ -199,28 +346,107 @@ class Wikipedia(object):
 
         return result
 
-    ratelimit = common.RateLimit(5)
+    @staticmethod
+    def ratelimit(host):
+        """Return the rate limit for a Wikipedia host (such as
+        en.wikipedia.org), which allows the revision check and the render
+        back-to-back."""
+        return common.host_ratelimit(host, 5, burst=2)
 
     def by_url(self, url):
-        """Load a Wikipedia article by URL, parse it, and return a result."""
+        """Load a Wikipedia article by URL (or from the cache, if it has the
+        current revision), parse it, and return a result."""
+
+        host, param, value = page_params(url)
+        if not self.cache or not param:
+            return self._by_url(url)[0]
+        key = u'%s:%s=%s' % (host, param, value.decode('utf-8'))
+
+        entry = self.cache.lookup(key)
+        if entry and not entry[2]:
+            return entry[0]
+        if entry:
+            # Expired: check if the article has been edited since
+            revision = self._lastrevid(host, param, value)
+            if revision is not None and revision == entry[1]:
+                self.cache.touch(key, CACHE_TTL)
+                return entry[0]
+
+        result, revision = self._by_url(url)
+        if revision is not None:
+            self.cache.put(key, result, CACHE_TTL, revision=revision)
+        return result
+
+    def by_url_async(self, url):
+        """Start loading an article on the shared lookup pool, returning an
+        AsyncResult for the result of by_url."""
+        return common.run_async(self.by_url, url)
+
+    def _lastrevid(self, host, param, value):
+        """Look up the latest revision ID of an article by title or curid,
+        without rendering it. Returns None if the page does not exist."""
 
-        self.ratelimit.wait()
+        self.ratelimit(host).wait()
+
+        query = {'action': 'query', 'prop': 'info', 'format': 'json',
+                 {'title': 'titles', 'curid': 'pageids'}[param]: value}
+        url = 'https://%s/w/api.php?%s' % (host, urllib.urlencode(query))
+        obj = json.loads(httpclient.get(url, {'User-Agent': USER_AGENT},
+                                        timeout=TIMEOUT))
+
+        pages = obj['query']['pages'].values()
+        assert len(pages) == 1
+        return str(pages[0]['lastrevid']) if 'lastrevid' in pages[0] \
+            else None
+
+    def _by_url(self, url):
+        """Load a Wikipedia article by URL, parse it, and return a result
+        and the revision ID of the article (None if it is not known).
+        Articles given by title or curid are rendered with the API, whose
+        response has the revision ID."""
+
+        host, param, value = page_params(url)
+        self.ratelimit(host).wait()
 
         # Request results
         headers = {'User-Agent': USER_AGENT}
-        req = urllib2.Request(url, None, headers)
         try:
-            response = urllib2.urlopen(req, timeout=8*60)
-        except urllib2.HTTPError as e:
+            response = httpclient.request(
+                'GET', api_url(host, param, value) if param else url,
+                headers=headers, timeout=TIMEOUT)
+        except httpclient.HTTPError as e:
             if e.code < 400 or e.code > 499:
                 raise
-            data = ''
             print "Ignoring error %d from Wikipedia" % (e.code,)
-        else:
-            data = response.read().decode('utf-8', errors='replace')
+            return self.parse('', url=url), None
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        pieces = itertools.chain(
+            (decoder.decode(chunk) for chunk
+             in iter(lambda: response.read(CHUNK_SIZE), '')),
+            [decoder.decode('', final=True)])
+        info = {}
+        if param:
+            pieces = parse_response(pieces, info)
 
-        # Parse and return response
-        return self.parse(data, url=url)
+        parser = WikipediaTextifier()
+        try:
+            if not self.streaming:
+                parser.feed(u''.join(pieces))
+            else:
+                # Parse the article as it arrives, and stop reading when
+                # the rest is not needed
+                for piece in pieces:
+                    parser.feed(piece)
+                    if self.enough(parser):
+                        break
+        finally:
+            response.close()
+        if 'error' in info:
+            print "Ignoring error %s from Wikipedia" % \
+                (info['error'].get('code'),)
+        revision = info.get('revid')
+        return (self.result(parser, url=url),
+                str(revision) if revision is not None else None)
 
 if __name__ == '__main__':
     import sys